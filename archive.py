@@ -0,0 +1,125 @@
+"""
+Archives counted as directories: members of zip, wheel and tar archives are listed and analysed straight from the
+archive, nothing is extracted to disk.
+"""
+__author__ = 'jim'
+
+import os
+import posixpath
+import tarfile
+import zipfile
+from clc import Counter, analyse_stream
+
+ZIP_SUFFIXES = ('.zip', '.whl')
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz')
+
+
+def is_archive(path):
+    """
+    Tell whether 'path' names an archive by its extension.
+    """
+    return path.lower().endswith(ZIP_SUFFIXES + TAR_SUFFIXES)
+
+
+def _member_parts(name):
+    """
+    Return the parts of the path of a member named 'name', or None for members escaping the archive.
+    """
+    name = posixpath.normpath(name.lstrip('/'))
+    if name == '.' or name == '..' or name.startswith('../'):
+        return None
+    return name.split('/')
+
+
+class Archive:
+    """
+    Archive file 'path' seen as a directory tree whose top is 'path' itself: member 'pkg/mod.py' is file
+    'path/pkg/mod.py'. Directories of the members are known even if the archive has no entries for them.
+    Members of a zip archive are read on demand. A tar archive, which may be compressed as a whole, is read once as
+    a stream when opened, python members are analysed then, so it's never decompressed twice.
+    With languages.Registry 'languages', members of all its languages are counted by their scanners instead.
+    """
+    def __init__(self, path, languages=None):
+        self.path = path
+        self.languages = languages
+        self._dirs = {path: {}}  # directory -> {name: member name for files, None for sub directories}
+        self._sizes = {}  # file path -> size
+        self._fields = {}  # file path -> counter fields, of tar members
+        self._zip = None
+        if path.lower().endswith(ZIP_SUFFIXES):
+            self._zip = zipfile.ZipFile(path)
+            for info in self._zip.infolist():
+                self._add(info.filename, info.is_dir(), info.file_size)
+        else:
+            self._read_tar()
+
+    def _add(self, name, is_dir, size):
+        """
+        Add member 'name', with its directories. Return its path if it's a valid file, otherwise None.
+        """
+        parts = _member_parts(name)
+        if parts is None:
+            return None
+        directory = self.path
+        for part in parts[:-1] if not is_dir else parts:
+            entries = self._dirs[directory]
+            directory = os.path.join(directory, part)
+            if directory not in self._dirs:
+                entries[part] = None
+                self._dirs[directory] = {}
+        if is_dir:
+            return None
+        path = os.path.join(directory, parts[-1])
+        valid = parts[-1].endswith('.py') if self.languages is None else self.languages.accepts(parts[-1])
+        if valid and path not in self._dirs:
+            self._dirs[directory][parts[-1]] = name
+            self._sizes[path] = size
+            return path
+        return None
+
+    def _read_tar(self):
+        with tarfile.open(self.path, 'r|*') as tar:
+            for info in tar:
+                if not (info.isfile() or info.isdir()):
+                    continue  # links and special files.
+                path = self._add(info.name, info.isdir(), info.size)
+                if path is None:
+                    continue
+                counter = Counter(path)
+                self._analyse_stream(counter, tar.extractfile(info))
+                self._fields[path] = counter.fields()
+
+    def _analyse_stream(self, counter, f):
+        if self.languages is None:
+            analyse_stream(counter, f)
+        else:
+            self.languages.analyse_stream(counter, f)
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+    def list_dir(self, directory, keep=None):
+        """
+        Return a list of (path, size) of the sub directories and python files of 'directory' in the archive, in
+        member order, size is None for directories. 'keep' is the function of WalkFilter.matcher, if any.
+        """
+        result = []
+        for name, member in self._dirs[directory].items():
+            path = os.path.join(directory, name)
+            is_dir = member is None
+            if keep is None or keep(name, is_dir):
+                result.append((path, None if is_dir else self._sizes[path]))
+        return result
+
+    def analyse(self, counter):
+        """
+        Analyse the member of counter. Return its size, as it's not a file on disk.
+        """
+        path = counter.dof
+        if self._zip is None:
+            counter.set_fields(self._fields[path])
+        else:
+            with self._zip.open(self._dirs[os.path.dirname(path)][os.path.basename(path)]) as f:
+                self._analyse_stream(counter, f)
+        return self._sizes[path]
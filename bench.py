@@ -0,0 +1,315 @@
+"""
+Benchmark of the count phases on a synthetic source tree.
+cmd line usage:  bench [--files N] [--depth N] [--seed N] [-r N] [-o FILE] [--compare FILE] [options of the tree]
+                       [--deep] [--deep-nodes N] [--deep-depth N]
+The tree is generated by a seeded random generator, so the same options always give the same tree. Each phase is
+run --repeat times and the best time is kept. Results are printed, and saved as JSON with -o, --compare prints the
+ratio of each phase time to the one of a saved run.
+--deep also times walks and calc of a deep tree built in memory, against recursive versions of them.
+"""
+__author__ = 'jim'
+
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import clc
+import obsqueue
+
+_WORDS = ('count', 'line', 'node', 'tree', 'file', 'size', 'total', 'value', 'item', 'data', 'path', 'index')
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+def _source(rng, lines, comment_ratio, blank_ratio):
+    """
+    Return text of a python source file of 'lines' lines.
+    """
+    result = []
+    indent = ''
+    for n in range(lines):
+        kind = rng.random()
+        if kind < blank_ratio:
+            result.append('')
+        elif kind < blank_ratio + comment_ratio:
+            result.append('{}# {} {}'.format(indent, rng.choice(_WORDS), rng.choice(_WORDS)))
+        elif kind < blank_ratio + comment_ratio + 0.05:
+            result.append('def {}_{}(x):'.format(rng.choice(_WORDS), n))
+            indent = '    '
+        else:
+            result.append('{}{}_{} = x + {}'.format(indent, rng.choice(_WORDS), n, rng.randrange(1000)))
+    return '\n'.join(result) + '\n'
+
+
+def generate(top, files=1000, depth=4, fanout=4, mean_lines=200, sigma=1.0, comment_ratio=0.2, blank_ratio=0.15,
+             seed=0):
+    """
+    Generate a tree of 'files' python files under directory 'top', in directories up to 'depth' levels with up to
+    'fanout' sub directories each. Numbers of lines follow a log-normal distribution around 'mean_lines', the
+    larger 'sigma' the wider. 'comment_ratio' and 'blank_ratio' are the shares of comment and blank lines.
+    The same arguments always give the same tree. Return (number of files, number of bytes).
+    """
+    rng = random.Random(seed)
+    dirs = [top]
+    level = [top]
+    for _ in range(depth):
+        level = [os.path.join(parent, 'pkg{}'.format(i)) for parent in level for i in range(rng.randint(1, fanout))]
+        dirs += level
+    for directory in dirs:
+        os.makedirs(directory, exist_ok=True)
+
+    mu = 0 if mean_lines <= 0 else math.log(mean_lines) - sigma * sigma / 2
+    total_bytes = 0
+    for n in range(files):
+        lines = max(1, int(rng.lognormvariate(mu, sigma)))
+        data = _source(rng, lines, comment_ratio, blank_ratio).encode('utf-8')
+        with open(os.path.join(rng.choice(dirs), 'mod{}.py'.format(n)), 'wb') as f:
+            f.write(data)
+        total_bytes += len(data)
+    return files, total_bytes
+
+
+def bench_count(top):
+    """
+    Time the phases of one count of 'top'. Return a dict of phase -> seconds, and the tree.
+    """
+    times = {}
+    builder = _QuietBuilder(top)
+    start = time.perf_counter()
+    builder.setup()
+    times['walk'] = time.perf_counter() - start
+
+    counters = [node.counter for node in builder.tree.walker() if node.is_leaf() and not node.is_root()]
+    start = time.perf_counter()
+    for counter in counters:
+        clc.analyse_file(counter)
+    times['analyse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    builder.tree.calc(analyse=lambda counter: None)  # files are already analysed, only sums are done.
+    times['aggregate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    builder.tree.write_text_tree(io.StringIO())
+    times['render'] = time.perf_counter() - start
+    return times, builder.tree
+
+
+def bench_events(events, budget=0.008):
+    """
+    Time 'events' events put by a thread through an ObsQueue processed by ticks of 'budget' seconds, as the GUI
+    does. Return (seconds, stats of the queue).
+    """
+    q = obsqueue.ObsQueue()
+    done = []
+
+    def produce():
+        for i in range(events):
+            q.put(done.append, i)
+
+    start = time.perf_counter()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    while producer.is_alive() or len(done) < events:
+        q.process(budget)
+    elapsed = time.perf_counter() - start
+    producer.join()
+    return elapsed, q.stats()
+
+
+def deep_tree(nodes=1000000, depth=128):
+    """
+    Return ROOT of a CounterTree of about 'nodes' nodes built in memory: a chain of 'depth' directories, each with the
+    same number of files, whose counters are filled. Nothing is on disk.
+    """
+    root = clc.CounterTree('ROOT')
+    files_per_dir = max(0, (nodes - depth) // depth)
+    parent = root
+    for level in range(depth):
+        directory = clc.CounterTree('d{}'.format(level))
+        parent.append_child(directory)
+        for i in range(files_per_dir):
+            node = clc.CounterTree('f{}.py'.format(i), size=1)
+            node.counter.set_fields((i % 50, i % 7, i % 5, i % 50 + i % 7 + i % 5))
+            directory.append_child(node)
+        parent = directory
+    return root
+
+
+def _recursive_walker(node, pre_order=True):
+    # walker as it was, through nested generators.
+    if pre_order:
+        yield node
+    for child in node.children:
+        yield from _recursive_walker(child, pre_order)
+    if not pre_order:
+        yield node
+
+
+def _recursive_calc(node, cbk=None, analyse=clc.analyse_file):
+    # CounterTree.calc as it was.
+    go_on = True
+    if node.is_leaf() and not node.is_root():
+        analyse(node.counter)
+    else:
+        for child in node.children:
+            go_on = _recursive_calc(child, cbk, analyse)
+            node.counter += child.counter
+            if not go_on:
+                break
+    if callable(cbk):
+        go_on = cbk(node)
+    return go_on
+
+
+def bench_deep(nodes=1000000, depth=128, repeat=3):
+    """
+    Time pre-order and post-order walks and calc of a deep_tree, with the explicit stack versions of Tree and
+    CounterTree and with recursive ones. Directory counters are reset before each calc, so every run sums the same
+    tree, and runs giving different totals raise RuntimeError. Return a dict of phase -> results.
+    """
+    tree = deep_tree(nodes, depth)
+    count = sum(1 for _ in tree.walker())
+
+    def no_analyse(counter):
+        pass
+
+    def go_on(node):
+        return True
+
+    def reset_dirs():
+        # calc sums file counters into the directory ones, which must start from zero at each run.
+        for node in tree.walker():
+            if not node.is_leaf() or node.is_root():
+                node.counter.set_fields((0, 0, 0, 0))
+
+    runs = {
+        'walk_pre': (lambda: sum(1 for _ in tree.walker()), lambda: sum(1 for _ in _recursive_walker(tree)), None),
+        'walk_post': (lambda: sum(1 for _ in tree.walker(False)),
+                      lambda: sum(1 for _ in _recursive_walker(tree, False)), None),
+        'calc': (lambda: tree.calc(cbk=go_on, analyse=no_analyse),
+                 lambda: _recursive_calc(tree, cbk=go_on, analyse=no_analyse), reset_dirs),
+    }
+    results = {}
+    for phase, (iterative, recursive, setup) in runs.items():
+        times = []
+        totals = set()
+        for function in (iterative, recursive):
+            best = None
+            for _ in range(repeat):
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                function()
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+                totals.add(tree.counter.fields())
+            times.append(best)
+        if setup is not None and len(totals) != 1:
+            raise RuntimeError('{} runs gave different totals: {}'.format(phase, sorted(totals)))
+        results[phase] = {'seconds': times[0], 'nodes_per_s': count / times[0], 'recursive_seconds': times[1],
+                          'speedup': times[1] / times[0]}
+    return results
+
+
+def run(top, files, total_bytes, repeat=3, events=100000):
+    """
+    Return results of the best of 'repeat' runs of each phase.
+    """
+    best = {}
+    tree = None
+    for _ in range(repeat):
+        times, tree = bench_count(top)
+        for phase, seconds in times.items():
+            best[phase] = min(seconds, best.get(phase, seconds))
+    nodes = sum(1 for _ in tree.walker())
+    megabytes = total_bytes / (1 << 20)
+    results = {
+        'walk': {'seconds': best['walk'], 'files_per_s': files / best['walk']},
+        'analyse': {'seconds': best['analyse'], 'files_per_s': files / best['analyse'],
+                    'mb_per_s': megabytes / best['analyse']},
+        'aggregate': {'seconds': best['aggregate'], 'nodes_per_s': nodes / best['aggregate']},
+        'render': {'seconds': best['render'], 'nodes_per_s': nodes / best['render']},
+    }
+    seconds, stats = min((bench_events(events) for _ in range(repeat)), key=lambda result: result[0])
+    results['events'] = {'seconds': seconds, 'events_per_s': events / seconds,
+                         'avg_latency': stats['avg_latency'], 'max_latency': stats['max_latency']}
+    return results
+
+
+def _print_results(results, baseline=None):
+    for phase, result in results['phases'].items():
+        rates = ', '.join('{} {:.1f}'.format(key, value) for key, value in result.items()
+                          if key.endswith('_per_s'))
+        line = '{:<10} {:9.4f} s  {}'.format(phase, result['seconds'], rates)
+        if 'speedup' in result:
+            line += '  recursive {:.4f} s, x{:.2f} faster'.format(result['recursive_seconds'], result['speedup'])
+        if baseline and phase in baseline['phases']:
+            line += '  x{:.2f} of baseline time'.format(result['seconds'] / baseline['phases'][phase]['seconds'])
+        print(line)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark count phases on a generated source tree.')
+    parser.add_argument('--files', type=int, default=2000, help='number of files, default is 2000')
+    parser.add_argument('--depth', type=int, default=4, help='levels of directories, default is 4')
+    parser.add_argument('--fanout', type=int, default=4, help='most sub directories per directory, default is 4')
+    parser.add_argument('--mean-lines', type=int, default=200, help='mean lines per file, default is 200')
+    parser.add_argument('--sigma', type=float, default=1.0, help='spread of lines per file, default is 1.0')
+    parser.add_argument('--comment-ratio', type=float, default=0.2, help='share of comment lines, default is 0.2')
+    parser.add_argument('--blank-ratio', type=float, default=0.15, help='share of blank lines, default is 0.15')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generator, default is 0')
+    parser.add_argument('--events', type=int, default=100000, help='events put through ObsQueue, default is 100000')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of each phase, best is kept, default is 3')
+    parser.add_argument('--deep', action='store_true', help='also time walks and calc of a deep tree in memory')
+    parser.add_argument('--deep-nodes', type=int, default=1000000, help='nodes of the deep tree, default is 1000000')
+    parser.add_argument('--deep-depth', type=int, default=128, help='depth of the deep tree, default is 128')
+    parser.add_argument('--dir', help='generate the tree in DIR and keep it, instead of a temporary directory')
+    parser.add_argument('-o', '--output', metavar='FILE', help='save results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved in FILE')
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in ('files', 'depth', 'fanout', 'mean_lines', 'sigma',
+                                                  'comment_ratio', 'blank_ratio', 'seed', 'events', 'repeat')}
+    if args.deep:
+        params.update(deep_nodes=args.deep_nodes, deep_depth=args.deep_depth)
+    top = args.dir or tempfile.mkdtemp(prefix='clc-bench-')
+    try:
+        files, total_bytes = generate(top, args.files, args.depth, args.fanout, args.mean_lines, args.sigma,
+                                      args.comment_ratio, args.blank_ratio, args.seed)
+        results = {
+            'params': params,
+            'tree': {'files': files, 'bytes': total_bytes},
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'phases': run(top, files, total_bytes, args.repeat, args.events),
+        }
+    finally:
+        if not args.dir:
+            shutil.rmtree(top)
+    if args.deep:
+        results['phases'].update(bench_deep(args.deep_nodes, args.deep_depth, args.repeat))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print('warning: baseline was run with other parameters', file=sys.stderr)
+    print('{} files, {:.1f} MB'.format(files, total_bytes / (1 << 20)))
+    _print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
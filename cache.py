@@ -0,0 +1,108 @@
+"""
+Persistent result cache, so that files not changed since last run need not be analysed again.
+"""
+__author__ = 'jim'
+
+import os
+import struct
+
+MAGIC = b'CLC\x01'
+_PATH_LEN = struct.Struct('<H')
+# size, mtime_ns, inode, line_code, line_comment, line_blank, line_total
+_RECORD = struct.Struct('<QqQqqqq')
+
+
+class ResultCache:
+    """
+    Cache of the four Counter fields of each file, stored in file 'file_name'. An entry is valid as long as the
+    file has the same (size, mtime_ns, inode) as when it was analysed.
+    On disk it is the MAGIC header followed by one record per file: path length, utf-8 path, then _RECORD.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # path -> (size, mtime_ns, inode, line_code, line_comment, line_blank, line_total)
+        self._identities = {}  # path -> (size, mtime_ns, inode) of files looked up in this run
+        self.load()
+
+    @staticmethod
+    def _key(counter):
+        return os.path.abspath(counter.dof)
+
+    def load(self):
+        """
+        Load entries from disk. A missing or unrecognized cache file is treated as an empty cache.
+        """
+        self._entries.clear()
+        try:
+            with open(self.file_name, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if not data.startswith(MAGIC):
+            return
+
+        pos = len(MAGIC)
+        try:
+            while pos < len(data):
+                (path_len,) = _PATH_LEN.unpack_from(data, pos)
+                pos += _PATH_LEN.size
+                path = data[pos:pos + path_len].decode('utf-8', 'surrogateescape')
+                pos += path_len
+                self._entries[path] = _RECORD.unpack_from(data, pos)
+                pos += _RECORD.size
+        except struct.error:
+            pass  # truncated file, keep the complete records.
+
+    def save(self):
+        """
+        Write entries to disk. Entries of files which no longer exist are evicted. The file is replaced atomically,
+        so an interrupted save never leaves a broken cache.
+        """
+        chunks = [MAGIC]
+        for path, record in self._entries.items():
+            if path not in self._identities and not os.path.isfile(path):
+                continue
+            path_bytes = path.encode('utf-8', 'surrogateescape')
+            chunks.append(_PATH_LEN.pack(len(path_bytes)))
+            chunks.append(path_bytes)
+            chunks.append(_RECORD.pack(*record))
+
+        tmp_name = self.file_name + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            f.write(b''.join(chunks))
+        os.replace(tmp_name, self.file_name)
+
+    def lookup(self, counter):
+        """
+        Fill counter from the cache. Return True if found, otherwise False and counter is untouched.
+        """
+        key = self._key(counter)
+        st = os.stat(key)
+        identity = (st.st_size, st.st_mtime_ns, st.st_ino)
+        self._identities[key] = identity
+        record = self._entries.get(key)
+        if record is not None and record[:3] == identity:
+            counter.set_fields(record[3:])
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def store(self, counter):
+        """
+        Store the fields of an analysed counter, lookup should have been called with it before.
+        """
+        key = self._key(counter)
+        self._entries[key] = self._identities[key] + counter.fields()
+
+    def wrap(self, analyse):
+        """
+        Return an analyse function for CounterTree.calc, which only calls 'analyse' on cache misses.
+        """
+        def cached_analyse(counter):
+            if not self.lookup(counter):
+                analyse(counter)
+                self.store(counter)
+        return cached_analyse
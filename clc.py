@@ -1,29 +1,232 @@
 """
-cmd line usage:  clc [dir_or_file]
+cmd line usage:  clc [-j N] [-p] [-w] [--compact] [--stats] [--exclude GLOB] [--include GLOB] [--gitignore]
+                     [--ignore-file NAME] [--max-depth N] [--git REV] [--dedup] [--dedup-report] [--cache FILE]
+                     [--mmap-threshold MB] [--shard FILE] [--deadline SECONDS] [--path PATH] [--top N]
+                     [--by FIELD] [--languages NAMES] [-f FORMAT] [-o FILE] [dir_or_file]
 if dir_or_file is not provided, then current work directory will be used.
+An archive, .zip, .whl or .tar with any compression, is counted as a directory, without extracting it.
+-j/--jobs N analyses files with N processes, 0 means one process per CPU.
+-p/--pipeline walks directories and analyses files at the same time.
+-w/--watch keeps counting changed files after the first count, and writes the report again after each change.
+--compact stores the tree in arrays, for trees of millions of files.
+--stats prints time of each phase and the slowest files and directories to standard error.
+--exclude GLOB and --include GLOB, which may be repeated, exclude entries and keep only matching files, with
+  .gitignore syntax. --gitignore reads .gitignore files, --ignore-file NAME reads rule files NAME. --max-depth N does
+  not walk directories more than N levels under dir_or_file.
+--git REV counts the tree of commit REV of the git repository dir_or_file from its objects, without checkout. It may
+  be repeated, a report is written for each commit, and each file content is analysed once for all of them.
+--dedup analyses files of identical content once, --dedup-report also prints how many lines come from copies to
+  standard error.
+--cache FILE keeps results in FILE, files not changed since last run are not analysed again.
+--mmap-threshold MB memory maps files of at least MB megabytes instead of reading them.
+--shard FILE saves the counted tree to FILE, for shard.py to merge it with the counts of other parts. A partial
+  count of --deadline is not saved, and --shard can not be used with --languages.
+--deadline SECONDS analyses files largest first, and reports the partial tree counted when SECONDS are over.
+--languages NAMES counts files of the comma separated languages, or of all known ones, by their comment rules, and
+  reports lines by language.
+--path PATH prints the counter of PATH, --top N the N largest files and directories by --by lines, instead of the
+  report on standard output.
+-f/--format FORMAT is one of text, jsonl and csv, -o/--output FILE writes the report to FILE.
 """
 __author__ = 'jim'
 
+import contextlib
+import heapq
+import mmap
 import os
+import re
+import stat
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from stats import timed_analyse
 from tree import Tree
 
+READ_CHUNK_SIZE = 1 << 20  # bytes read at once by analyse_stream
+MMAP_THRESHOLD = 64 << 20  # files of at least this size are memory mapped by analyse_file, None to never map
+MMAP_WINDOW_SIZE = 16 << 20  # bytes scanned at once by analyse_mapped
+CALC_BATCH_SIZE = 64  # number of files sent to a worker process at once by CounterTree.calc_parallel
 
-def analyse_file(counter):
-    with open(counter.dof) as f:
-        for line in f:
-            counter.line_total += 1
-            if not line or (line and line.isspace()):
-                # empty line
-                counter.line_blank += 1
+
+# White space recognized by str.isspace in ascii range, except line breaks.
+_SPACE = rb'[ \t\x0b\x0c\x1c-\x1f]*+'
+# Head of a line is its first character after white space: '#' for comment line, empty for blank line, or a non
+# ascii byte, which may start unicode white space. Other lines are code lines and do not match.
+_HEAD = _SPACE + rb'([#\x80-\xff]|(?=\n))'
+_FIRST_LINE_HEAD = re.compile(_HEAD)
+_LINE_HEAD = re.compile(rb'\n' + _HEAD)
+_LINE_BREAK = re.compile(rb'\n')
+_NON_ASCII_LINE = re.compile(rb'\n(' + _SPACE + rb'[\x80-\xff][^\n]*)')
+
+
+def _analyse_line(counter, line):
+    """
+    Classify a single line given as str.
+    """
+    counter.line_total += 1
+    if line.isspace():
+        # empty line
+        counter.line_blank += 1
+    elif line.strip().startswith('#'):
+        # comment line
+        counter.line_comment += 1
+    else:
+        # code line
+        counter.line_code += 1
+
+
+def _analyse_lines(counter, buf, line_total, start, end):
+    """
+    Count the 'line_total' complete lines in buf[start:end] into counter. 'buf' is bytes or a memory map using '\\n'
+    only as line break, and 'start' is either 0 or just after a '\\n'. Instead of a loop over lines, the heads of all
+    blank and comment lines are found by one regular expression scan in place. Only lines starting with non ascii
+    characters are decoded, so the result is the same as classifying each decoded line.
+    """
+    if start:
+        heads = _LINE_HEAD.findall(buf, start - 1, end)
+        first = None
+    else:
+        heads = _LINE_HEAD.findall(buf, 0, end)
+        first = _FIRST_LINE_HEAD.match(buf, 0, end)
+        if first:
+            heads.append(first.group(1))
+    line_blank = heads.count(b'')
+    line_comment = heads.count(b'#')
+    if len(heads) > line_blank + line_comment:
+        lines = _NON_ASCII_LINE.findall(buf, max(start - 1, 0), end)
+        if first and first.group(1) >= b'\x80':
+            lines.append(buf[0:buf.find(b'\n')])
+        for line in lines:
+            line = line.decode('utf-8', 'replace')
+            if line.isspace():
+                line_blank += 1
             elif line.strip().startswith('#'):
-                # comment line
-                counter.line_comment += 1
-            else:
-                # code line
-                counter.line_code += 1
+                line_comment += 1
+
+    counter.line_total += line_total
+    counter.line_blank += line_blank
+    counter.line_comment += line_comment
+    counter.line_code += line_total - line_blank - line_comment
+
+
+def _analyse_block(counter, data, end):
+    """
+    Count lines of data[:end], which ends with a line break.
+    """
+    if b'\r' in data:
+        data = data[:end].replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        end = len(data)
+    _analyse_lines(counter, data, data.count(b'\n', 0, end), 0, end)
+
+
+def analyse_stream(counter, f, chunk_size=READ_CHUNK_SIZE):
+    """
+    Count lines read from binary file object 'f' into counter. 'f' is read in chunks of 'chunk_size' bytes, each
+    chunk is analysed up to its last line break, the rest is carried over to the next chunk. Lines end with '\\n',
+    '\\r\\n' or '\\r' as in text mode. Any encoding is accepted, non utf-8 bytes never match white space or '#'.
+    """
+    rest = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        data = rest + chunk if rest else chunk
+        # a '\r' at the end may be followed by '\n' in next chunk, keep it in the rest.
+        end = len(data) - 1 if data.endswith(b'\r') else len(data)
+        cut = max(data.rfind(b'\n', 0, end), data.rfind(b'\r', 0, end)) + 1
+        if cut:
+            _analyse_block(counter, data, cut)
+        rest = data[cut:]
+
+    if rest.endswith(b'\r'):
+        _analyse_block(counter, rest, len(rest))
+    elif rest:
+        # last line has no line break.
+        _analyse_line(counter, rest.decode('utf-8', 'replace'))
+
+
+def analyse_mapped(counter, f, window_size=MMAP_WINDOW_SIZE):
+    """
+    Count lines of binary file object 'f' by scanning a read only memory map of it in place. The map is scanned in
+    windows of about 'window_size' bytes ending at line breaks, the regular expressions take the window bounds as
+    positions, so the file content is never copied and memory used stays flat however large the file is. As the
+    scan needs '\\n' line breaks, a file having '\\r' falls back to analyse_stream.
+    """
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm.find(b'\r') != -1:
+            f.seek(0)
+            analyse_stream(counter, f)
+            return
+
+        lines_end = mm.rfind(b'\n') + 1
+        start = 0
+        while start < lines_end:
+            end = min(start + window_size, lines_end)
+            if end < lines_end:
+                # end window at a line break, or at the end of a line longer than the window.
+                end = mm.rfind(b'\n', start, end) + 1 or mm.find(b'\n', end) + 1
+            line_total = len(_LINE_BREAK.findall(mm, start, end))
+            _analyse_lines(counter, mm, line_total, start, end)
+            start = end
+
+        if lines_end < len(mm):
+            # last line has no line break.
+            _analyse_line(counter, mm[lines_end:].decode('utf-8', 'replace'))
+
+
+def analyse_file(counter):
+    """
+    Files of at least MMAP_THRESHOLD bytes are scanned by analyse_mapped, smaller files by analyse_stream.
+    """
+    with open(counter.dof, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size and MMAP_THRESHOLD is not None and size >= MMAP_THRESHOLD:
+            analyse_mapped(counter, f)
+        else:
+            analyse_stream(counter, f)
+
+
+def _init_worker(mmap_threshold):
+    """
+    Initializer of CounterTree.calc_parallel worker processes, so that settings of the parent process apply.
+    """
+    global MMAP_THRESHOLD
+    MMAP_THRESHOLD = mmap_threshold
+
+
+def analyse_batch(counters, analyse=analyse_file, timed=False):
+    """
+    Analyse a batch of counters by 'analyse' and return their fields. It runs in the worker processes of
+    CounterTree.calc_parallel, the counters there are copies, so only the returned fields go back. If 'timed', the
+    result of each counter is (fields, seconds, CPU seconds, bytes read) instead, see set_batch_result.
+    """
+    if timed:
+        results = []
+        for counter in counters:
+            seconds, cpu, size = timed_analyse(analyse, counter)
+            results.append((counter.fields(), seconds, cpu, size))
+        return results
+    for counter in counters:
+        analyse(counter)
+    return [counter.fields() for counter in counters]
+
+
+def set_batch_result(counter, result, stats=None):
+    """
+    Set the fields of 'counter' from its 'result' of analyse_batch, which is timed if stats.CountStats 'stats' is
+    given, and record the file into stats then.
+    """
+    if stats is None:
+        counter.set_fields(result)
+    else:
+        fields, seconds, cpu, size = result
+        counter.set_fields(fields)
+        stats.record(os.path.normpath(counter.dof), seconds, cpu, size)
 
 
 class Counter:
+    __slots__ = ('dof', 'line_code', 'line_comment', 'line_blank', 'line_total')
+
     def __init__(self, directory_or_file):
         self.dof = directory_or_file
         self.line_code = 0
@@ -38,39 +241,140 @@ class Counter:
         self.line_total += other.line_total
         return self
 
+    def __isub__(self, other):
+        self.line_code -= other.line_code
+        self.line_comment -= other.line_comment
+        self.line_blank -= other.line_blank
+        self.line_total -= other.line_total
+        return self
+
+    def fields(self):
+        return self.line_code, self.line_comment, self.line_blank, self.line_total
+
+    def set_fields(self, fields):
+        self.line_code, self.line_comment, self.line_blank, self.line_total = fields
+
     def __str__(self):
         return 'Total: {}, Code: {}, Comment: {}, Blank: {}'.format(self.line_total, self.line_code,
                                                                     self.line_comment, self.line_blank)
 
 
 class CounterTree(Tree):
-    def __init__(self, directory_or_file):
+    # files left to analyse under this node, and their bytes, when a count was cut by a deadline, see schedule.py.
+    pending_files = 0
+    pending_bytes = 0
+    languages = None  # {language name: Counter} of the files under this node, set by languages.Registry.tally
+
+    def __init__(self, directory_or_file, size=0):
+        """
+        size: file size in bytes as found by DirBuilder.setup, 0 for directories.
+        """
         Tree.__init__(self)
         self.counter = Counter(directory_or_file)
+        self.size = size
 
-    def calc(self, node=None, cbk=None):
+    def calc(self, node=None, cbk=None, analyse=analyse_file):
         # Return value indicates go on or not.
-        # outside don't fill node. the node parameter is here to provide recursion ability for this method.
+        # outside don't fill node. the node parameter is here to calc a subtree.
+        # analyse is called with the counter of each file, it should fill the counter.
+        # The walk uses an explicit stack instead of recursion, the order of analyse and cbk calls is the one of a
+        # post-order walk. When a node returns stop, the loop over its siblings stops, its parent is complete and cbk
+        # is still called with it, whose return value goes up in turn.
         if node is None:
             node = self
 
-        go_on = True
-        if (node.is_leaf() and
-                not node.is_root()):  # root node is always not file, it's a dummy directory.
-            analyse_file(node.counter)
-        else:
-            for child in node.children:
-                go_on = self.calc(child, cbk)
-                node.counter += child.counter
-                if not go_on:
+        stack = []  # (directory node, iterator of its children not calc yet)
+        while True:
+            # go down into node.
+            if (node.is_leaf() and
+                    not node.is_root()):  # root node is always not file, it's a dummy directory.
+                analyse(node.counter)
+                go_on = True
+            else:
+                stack.append((node, iter(node.children)))
+                node = None
+            # go up: node is complete with go_on, or None to go on with the children of the top of stack.
+            while True:
+                if node is not None:
+                    if callable(cbk):
+                        go_on = cbk(node)
+                    if not stack:
+                        return go_on
+                    parent = stack[-1][0]
+                    parent.counter += node.counter
+                    if not go_on:
+                        node = stack.pop()[0]
+                        continue
+                node = next(stack[-1][1], None)
+                if node is not None:
                     break
+                node = stack.pop()[0]
+                go_on = True
 
-        if callable(cbk):
-            go_on = cbk(node)
-        return go_on
+    def calc_parallel(self, jobs, cbk=None, batch_size=CALC_BATCH_SIZE, cache=None, dedup=None,
+                      analyse=analyse_file, stats=None):
+        """
+        Same as calc, but files are analysed by 'analyse' in a pool of 'jobs' processes, so it must be picklable.
+        Files are sent to the pool in batches of 'batch_size' up front, and the results are consumed in the order
+        calc visits the files, so cbk is still called once per node in the same order. When cbk asks to stop,
+        batches not started yet are cancelled.
+        If a ResultCache is given, only the files missing in it are sent to the pool. If a dedup.ContentIndex is
+        given, copies of a file coming before them are not sent either, they get its fields. Files analysed are
+        timed by the workers and recorded into stats.CountStats 'stats', if given.
+        """
+        counters = [node.counter for node in self.walker() if node.is_leaf() and not node.is_root()]
+        copies = set()
+        if dedup is not None:
+            copies = {counter for counter in counters if dedup.is_copy(counter)}
+            counters = [counter for counter in counters if counter not in copies]
+        if cache is None:
+            cached = set()
+        else:
+            cached = {counter for counter in counters if cache.lookup(counter)}
+            counters = [counter for counter in counters if counter not in cached]
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(MMAP_THRESHOLD,))
+        try:
+            futures = [executor.submit(analyse_batch, counters[i:i + batch_size], analyse, stats is not None)
+                       for i in range(0, len(counters), batch_size)]
+            results = (result for future in futures for result in future.result())
+
+            def collect(counter):
+                if counter in copies:
+                    dedup.lookup(counter)
+                    return
+                if counter not in cached:
+                    set_batch_result(counter, next(results), stats)
+                    if cache is not None:
+                        cache.store(counter)
+                if dedup is not None:
+                    dedup.store(counter)
+
+            return self.calc(cbk=cbk, analyse=collect)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def largest(self, n, field='line_total', dirs=False):
+        """
+        Return the n files, or directories if 'dirs', of this subtree with the greatest counter field 'field',
+        greatest first. This node is not one of them. A heap of n nodes is kept while walking, the tree is not sorted.
+        """
+        nodes = (node for node in self.walker() if node is not self and not node.is_root() and
+                 node.is_leaf() != dirs)
+        return heapq.nlargest(n, nodes, key=lambda node: getattr(node.counter, field))
+
+    @property
+    def complete(self):
+        return not self.pending_files
 
     def __str__(self):
-        return '{} - {}'.format(os.path.split(self.counter.dof)[1], self.counter)
+        text = '{} - {}'.format(os.path.split(self.counter.dof)[1], self.counter)
+        if self.languages and not self.is_leaf():
+            text += ' - ' + ', '.join('{}: {}'.format(name, counter.line_total)
+                                      for name, counter in sorted(self.languages.items()))
+        if self.pending_files:
+            state = 'not analysed' if self.is_leaf() else 'partial, {} files not analysed'.format(self.pending_files)
+            text += ' - ' + state
+        return text
 
     @property
     def name(self):
@@ -78,37 +382,236 @@ class CounterTree(Tree):
 
 
 class DirBuilder:
-    def __init__(self, directory_or_file):
+    def __init__(self, directory_or_file, jobs=1, cache=None, stats=None, walk_filter=None, dedup=None,
+                 deadline=None, languages=None):
+        """
+        jobs: number of processes used by calc to analyse files, 1 means analyse in current process, 0 means one
+          process per CPU.
+        cache: a cache.ResultCache used by calc, saving it is left to the caller.
+        stats: a stats.CountStats filled by setup and calc, None to not instrument the count at all.
+        walk_filter: an ignore.WalkFilter of the same directory, deciding which entries are walked, None to walk all.
+        dedup: a dedup.ContentIndex, built by calc, so files of identical content are analysed once.
+        deadline: a time.monotonic() value, calc then analyses files largest first and stops at the deadline, leaving
+          a partial tree. self.schedule is the schedule.ScheduledCount telling what is left.
+        languages: a languages.Registry, files of all its languages are counted by their scanners, and calc sets the
+          breakdown by language of each node. None to count python files by analyse_file.
+        path_index maps the normalized path of each node of the tree to the node, it's built by setup.
+        """
         self.tree = CounterTree('ROOT')
         self.dof = directory_or_file
+        self.jobs = jobs
+        self.cache = cache
+        self.stats = stats
+        self.walk_filter = walk_filter
+        self.dedup = dedup
+        self.deadline = deadline
+        self.schedule = None
+        self.languages = languages
+        # analyses a file on disk, in this process or in worker processes.
+        self.analyse_file = analyse_file if languages is None else languages.analyse
+        self.archive = None  # archive.Archive, when directory_or_file is an archive
+        self.path_index = {}
 
     def _setup_a_tree(self, parent_node: CounterTree, directory_or_file: str):
         """
         For directory, if it contains no valid files nor sub directories, it will not be add in
         the tree.
+        The walk uses an explicit stack instead of recursion, so the depth of directories is not limited. Each
+        directory is listed by one os.scandir pass, the DirEntry objects already know the entry type, and the stat
+        of python files, which gives their size, is only done once.
         """
         dof = directory_or_file
-        if os.path.exists(dof):
-            if os.path.isdir(dof):
-                # it's a directory
-                dof_node = CounterTree(directory_or_file=dof)
-                for entry in os.listdir(dof):
-                    self._setup_a_tree(dof_node, os.path.join(dof, entry))
-                if not dof_node.is_leaf():
-                    parent_node.append_child(dof_node)
-            else:
-                # it's a file
-                if dof.endswith('.py'):
-                    parent_node.append_child(CounterTree(directory_or_file=dof))
-        else:
+        size = self._stat_top(dof)
+        if size is not None:
+            # it's a file
+            if self._is_valid(os.path.basename(dof)):
+                node = CounterTree(directory_or_file=dof, size=size)
+                parent_node.append_child(node)
+                self._index_node(node)
+            return
+
+        dof_node = CounterTree(directory_or_file=dof)
+        parent_node.append_child(dof_node)
+        self._index_node(dof_node)
+        dir_nodes = [dof_node]  # a directory is always after its parent directory in this list.
+        stack = [dof_node]
+        while stack:
+            dir_node = stack.pop()
+            for path, size in self._list_dir(dir_node.counter.dof):
+                child = CounterTree(directory_or_file=path, size=size or 0)
+                dir_node.append_child(child)
+                self._index_node(child)
+                if size is None:
+                    dir_nodes.append(child)
+                    stack.append(child)
+
+        # remove directories without valid files, sub directories first.
+        for dir_node in reversed(dir_nodes):
+            if dir_node.is_leaf():
+                dir_node.parent.cut_child(dir_node.index)
+                self._unindex_node(dir_node)
+
+    def _index_node(self, node):
+        path = os.path.normpath(node.counter.dof)
+        # keep one string per path when it's already normalized.
+        self.path_index[node.counter.dof if path == node.counter.dof else path] = node
+
+    def _unindex_node(self, node):
+        self.path_index.pop(os.path.normpath(node.counter.dof), None)
+
+    def reindex(self):
+        """
+        Build path_index again from self.tree, e.g. after the tree was replaced.
+        """
+        self.path_index.clear()
+        for node in self.tree.walker():
+            if not node.is_root():
+                self._index_node(node)
+
+    def _candidates(self, path):
+        """
+        Generate the forms 'path' may have in the tree: as it is, relative to the counted directory if it's relative,
+        and in the form of the counted directory, absolute or relative to the work directory, if it's inside it.
+        """
+        yield path
+        if not os.path.isabs(path):
+            yield os.path.join(self.dof, path)
+        try:
+            inner = os.path.relpath(os.path.abspath(path), os.path.abspath(self.dof))
+        except ValueError:
+            return  # e.g. on another drive.
+        if inner != os.pardir and not inner.startswith(os.pardir + os.sep):
+            yield os.path.join(self.dof, inner)
+
+    def find(self, path):
+        """
+        Return the node of 'path' in the counted tree, or None. A relative path is looked up as it is, then relative
+        to the counted directory, and an absolute path is found as well in a tree counted from a relative one, and
+        the other way round. It costs a few dict lookups, so O(length of path), whatever the size of the tree.
+        """
+        for candidate in self._candidates(path):
+            node = self.path_index.get(os.path.normpath(candidate))
+            if node is not None:
+                return node
+        return None
+
+    def _stat_top(self, directory_or_file):
+        """
+        Return size of the file to count, or None if it's a directory. Raise ValueError if it does not exist.
+        An archive is opened and counted as a directory.
+        """
+        try:
+            st = os.stat(directory_or_file)
+        except OSError:
             raise ValueError('Directory or file "{}" invalid'.format(self.dof))
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if stat.S_ISDIR(st.st_mode):
+            return None
+        import archive  # archive imports this module.
+        if not archive.is_archive(directory_or_file):
+            return st.st_size
+        try:
+            self.archive = archive.Archive(directory_or_file, self.languages)
+        except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as err:
+            raise ValueError('Archive "{}" invalid: {}'.format(self.dof, err))
+        return None
+
+    def _is_valid(self, name):
+        """
+        Tell whether file 'name' is counted: a python file, or a file of a language of self.languages.
+        """
+        if self.languages is None:
+            return name.endswith('.py')
+        return self.languages.accepts(name)
+
+    def _list_dir(self, directory):
+        """
+        List directory by one os.scandir pass. Return a list of (path, size) of its sub directories and valid files,
+        in listing order, size is None for directories. Entries rejected by walk_filter are left out, so excluded
+        directories are never listed. Directories of an archive are listed from its members.
+        """
+        result = []
+        keep = None if self.walk_filter is None else self.walk_filter.matcher(directory)
+        if self.archive is not None:
+            return self.archive.list_dir(directory, keep)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if keep is None or keep(entry.name, True):
+                        result.append((entry.path, None))
+                elif self._is_valid(entry.name) and (keep is None or keep(entry.name, False)):
+                    try:
+                        result.append((entry.path, entry.stat().st_size))
+                    except OSError:
+                        pass  # broken symbolic link.
+        return result
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager timing phase 'name' of the count in self.stats, then calling cbk_stats. Nothing is done
+        without stats.
+        """
+        if self.stats is None:
+            yield
+            return
+        self.stats.top = os.path.normpath(self.dof)
+        with self.stats.phase(name):
+            yield
+        self.cbk_stats(self.stats)
+
+    def analyse_function(self):
+        """
+        Return the function analysing the counter of a file in the current process, through the cache and the
+        stats if there are. Members of an archive are not cached, as they have no identity on disk.
+        """
+        analyse = self.analyse_file if self.archive is None else self.archive.analyse
+        if self.stats is not None:
+            analyse = self.stats.wrap(analyse)
+        if self.cache is not None and self.archive is None:
+            analyse = self.cache.wrap(analyse)
+        return analyse
 
     def setup(self):
-        self.tree.children.clear()
-        self._setup_a_tree(self.tree, self.dof)
+        with self.phase('walk'):
+            self.tree.children.clear()
+            self.path_index.clear()
+            self.tree.counter = Counter('ROOT')
+            self._setup_a_tree(self.tree, self.dof)
 
     def calc(self):
-        self.tree.calc(cbk=self.cbk_analyse)
+        jobs = self.jobs or os.cpu_count()
+        if self.dedup is not None and self.archive is None:
+            with self.phase('dedup'):
+                self.dedup.build((node.counter.dof, node.size) for node in self.tree.walker()
+                                 if node.is_leaf() and not node.is_root())
+        with self.phase('calc'):
+            if self.deadline is not None:
+                self._calc_scheduled(jobs)
+            elif jobs > 1 and self.archive is None:
+                self.tree.calc_parallel(jobs, cbk=self.cbk_analyse, cache=self.cache, dedup=self.dedup,
+                                        analyse=self.analyse_file, stats=self.stats)
+            else:
+                analyse = self.analyse_function()
+                if self.dedup is not None and self.archive is None:
+                    analyse = self.dedup.wrap(analyse)
+                self.tree.calc(cbk=self.cbk_analyse, analyse=analyse)
+            if self.languages is not None:
+                self.languages.tally(self.tree)
+
+    def _calc_scheduled(self, jobs):
+        import schedule  # schedule imports this module.
+        analyse = self.analyse_function()
+        dedup = self.dedup if self.archive is None else None
+        if dedup is not None:
+            analyse = dedup.wrap(analyse)
+        if self.archive is not None:
+            jobs = 1
+        self.schedule = schedule.ScheduledCount(self.tree, self.deadline, jobs, analyse, self.cache, dedup,
+                                                self.analyse_file, self.stats)
+        self.schedule.run(self.cbk_analyse)
 
     def cbk_analyse(self, node):
         """
@@ -118,16 +621,222 @@ class DirBuilder:
         print('.', end='', flush=True)
         return True
 
+    def cbk_discover(self, node):
+        """
+        This method is called after each node has been added to the tree during pipelined count.
+        """
+
+    def cbk_remove(self, node):
+        """
+        This method is called after a directory without valid files has been removed from the tree during pipelined
+        count.
+        """
+
+    def cbk_stats(self, stats):
+        """
+        This method is called with self.stats after each phase of the count, only if there are stats.
+        """
+
 
 if __name__ == '__main__':
+    import argparse
     import sys
-    if len(sys.argv) > 1:
-        dof = sys.argv[1]
+    import report
+    parser = argparse.ArgumentParser(description='Count code lines of python source files.')
+    parser.add_argument('dof', nargs='?', default=os.getcwd(), metavar='dir_or_file',
+                        help='directory or file to count, default is current work directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes used to analyse files, 0 means one per CPU')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='keep results in FILE, so unchanged files are not analysed again in next run')
+    parser.add_argument('--mmap-threshold', type=int, metavar='MB',
+                        help='memory map files of at least MB megabytes, default is {}'.format(MMAP_THRESHOLD >> 20))
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help='walk directories and analyse files at the same time, with --jobs analysis threads')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='after the count, watch changes and write the report again after each one, until Ctrl-C')
+    parser.add_argument('--compact', action='store_true',
+                        help='store the tree in arrays to save memory on huge trees, not with --pipeline or --watch')
+    parser.add_argument('--stats', action='store_true',
+                        help='print time of each phase, bytes read and the slowest files to standard error')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                        help='exclude files and directories matching GLOB, in .gitignore syntax, may be repeated')
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB',
+                        help='only count files matching GLOB, in .gitignore syntax, may be repeated')
+    parser.add_argument('--gitignore', action='store_true',
+                        help='apply .gitignore files found while walking, and skip .git directories')
+    parser.add_argument('--ignore-file', action='append', default=[], metavar='NAME',
+                        help='apply rule files NAME, in .gitignore syntax, found while walking, may be repeated')
+    parser.add_argument('--max-depth', type=int, metavar='N',
+                        help='do not walk directories more than N levels under dir_or_file')
+    parser.add_argument('--git', action='append', default=[], metavar='REV',
+                        help='count commit REV of git repository dir_or_file from its objects, may be repeated')
+    parser.add_argument('--dedup', action='store_true',
+                        help='analyse files of identical content once, not with --pipeline, --watch or --git')
+    parser.add_argument('--dedup-report', action='store_true',
+                        help='same as --dedup, and print lines coming from duplicate content to standard error')
+    parser.add_argument('--shard', metavar='FILE',
+                        help='save the counted tree to FILE for shard.py, json if FILE ends with .json or .jsonl, '
+                             'otherwise binary')
+    parser.add_argument('--languages', metavar='NAMES',
+                        help='count files of comma separated languages, or all known ones with "all", instead of '
+                             'python files only, with their block comments, strings and docstrings, and report lines '
+                             'by language. Not with --compact, --git, --cache, --dedup or --shard')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help='analyse files largest first and report what is counted after SECONDS from start, '
+                             'not with --pipeline, --watch, --compact or --git')
+    parser.add_argument('--path', action='append', default=[], metavar='PATH',
+                        help='print the counter of PATH, relative paths are also tried under dir_or_file, '
+                             'may be repeated')
+    parser.add_argument('--top', type=int, metavar='N', help='print the N largest files and directories')
+    parser.add_argument('--by', choices=('total', 'code', 'comment', 'blank'), default='total',
+                        help='lines ranking --top, default is total')
+    parser.add_argument('-f', '--format', choices=sorted(report.WRITERS),
+                        help='report format, default is text, or according to extension of the output file')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write report to FILE instead of standard output')
+    args = parser.parse_args()
+    # queries are printed instead of the report, unless it's written to a file.
+    queried = bool(args.path) or args.top is not None
+    if args.compact and (args.pipeline or args.watch):
+        parser.error('--compact can not be used with --pipeline or --watch')
+    if args.git and (args.compact or args.watch or args.cache or args.gitignore or args.ignore_file):
+        parser.error('--git can not be used with --compact, --watch, --cache or rule files')
+    if args.languages and (args.compact or args.git or args.cache or args.dedup or args.dedup_report or args.shard):
+        parser.error('--languages can not be used with --compact, --git, --cache, --dedup or --shard')
+    if args.deadline is not None and (args.pipeline or args.watch or args.compact or args.git):
+        parser.error('--deadline can not be used with --pipeline, --watch, --compact or --git')
+    args.dedup = args.dedup or args.dedup_report
+    if args.dedup and (args.pipeline or args.watch or args.git):
+        parser.error('--dedup can not be used with --pipeline, --watch or --git')
+    if args.watch and os.path.isfile(args.dof):
+        import archive
+        if archive.is_archive(args.dof):
+            parser.error('--watch can not be used with an archive')
+
+    registry = None
+    if args.languages:
+        import languages
+        try:
+            registry = languages.registry(args.languages)
+        except ValueError as err:
+            parser.error(str(err))
+
+    deadline = None
+    if args.deadline is not None:
+        import time
+        deadline = time.monotonic() + args.deadline  # the walk is part of the budget.
+
+    if args.mmap_threshold is not None:
+        MMAP_THRESHOLD = args.mmap_threshold << 20
+        import clc  # modules imported below see this module as clc, not __main__.
+        clc.MMAP_THRESHOLD = MMAP_THRESHOLD
+
+    result_cache = None
+    if args.cache:
+        from cache import ResultCache
+        result_cache = ResultCache(args.cache)
+
+    count_stats = None
+    if args.stats:
+        from stats import CountStats
+        count_stats = CountStats()
+
+    content_index = None
+    if args.dedup:
+        from dedup import ContentIndex
+        content_index = ContentIndex()
+
+    walk_filter = None
+    rule_files = args.ignore_file + (['.gitignore'] if args.gitignore else [])
+    if args.exclude or args.include or rule_files or args.max_depth is not None:
+        from ignore import WalkFilter
+        walk_filter = WalkFilter(args.dof, args.exclude, args.include, rule_files, args.max_depth)
+
+    if args.git:
+        from gitobjects import BlobCounts, GitDirBuilder, Repository, GitError
+        try:
+            repository = Repository(args.dof)
+        except GitError as err:
+            parser.error(str(err))
+        blob_counts = BlobCounts()
+        builders = []
+        for rev in args.git:
+            if walk_filter is not None:
+                walk_filter = WalkFilter(rev.replace('/', '-'), args.exclude, args.include, (), args.max_depth)
+            builders.append(GitDirBuilder(repository, rev, blob_counts, stats=count_stats, walk_filter=walk_filter))
+    elif args.compact:
+        from compact import CompactDirBuilder
+        builders = [CompactDirBuilder(args.dof, jobs=args.jobs, cache=result_cache, stats=count_stats,
+                                      walk_filter=walk_filter, dedup=content_index)]
     else:
-        dof = os.getcwd()
+        builders = [DirBuilder(args.dof, jobs=args.jobs, cache=result_cache, stats=count_stats,
+                               walk_filter=walk_filter, dedup=content_index, deadline=deadline, languages=registry)]
 
-    db = DirBuilder(dof)
-    db.setup()
-    db.calc()
-    print('')
-    print(db.tree.text_tree())
+    def write(db):
+        if result_cache is not None:
+            result_cache.save()
+        print('')
+        with db.phase('render'):
+            if args.output:
+                with open(args.output, 'a' if len(builders) > 1 else 'w') as f:
+                    report.write_report(db.tree, f, args.format or report.format_of(args.output))
+            elif not queried:
+                report.write_report(db.tree, sys.stdout, args.format or 'text')
+                if (args.format or 'text') == 'text':
+                    print('')
+        if queried:
+            query(db)
+        if count_stats is not None:
+            print(count_stats, file=sys.stderr)
+        if db.schedule is not None and not db.schedule.complete:
+            print(db.schedule.summary(), file=sys.stderr)
+        if args.dedup_report:
+            print(content_index.report(db.tree.counter.line_total), file=sys.stderr)
+        if args.shard:
+            import shard
+            # with several builders, the shard has a top per builder counted so far.
+            trees = [d.tree for d in builders[:builders.index(db) + 1]]
+            try:
+                shard.check(trees)
+            except ValueError as err:
+                sys.exit('clc: {}, --shard not written'.format(err))
+            with open(args.shard, 'wb') as f:
+                shard.dump(trees, f, shard.format_of(args.shard))
+
+    def query(db):
+        for path in args.path:
+            node = db.find(path)
+            print('{} - {}'.format(node.counter.dof, node.counter) if node is not None else
+                  '{} - not counted'.format(path))
+        if args.top is not None:
+            field = 'line_' + args.by
+            for dirs, title in ((False, 'files'), (True, 'directories')):
+                print('Largest {} by {} lines:'.format(title, args.by))
+                for node in db.tree.largest(args.top, field, dirs):
+                    print('  {:>8}  {}'.format(getattr(node.counter, field), node.counter.dof))
+
+    if args.output and len(builders) > 1:
+        open(args.output, 'w').close()
+    for db in builders:
+        if args.pipeline:
+            from pipeline import PipelinedCount
+            PipelinedCount(db).run()
+            if registry is not None:
+                registry.tally(db.tree)
+        else:
+            db.setup()
+            db.calc()
+        write(db)
+    if args.watch:
+        from watch import TreeWatcher
+        watcher = TreeWatcher(db)
+        try:
+            while True:
+                if watcher.check():
+                    if registry is not None:
+                        registry.tally(db.tree)  # counters of changed files went up to their directories only.
+                    write(db)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
@@ -0,0 +1,84 @@
+"""
+Thin client of the count server, see server.py. It only imports what talking to the server needs, so it starts in
+a few milliseconds, the count itself is done by the server.
+cmd line usage:  client [--socket PATH] [-f FORMAT] [-o FILE] [--roots | --drop | --stop] [dir_or_file]
+if dir_or_file is not provided, then current work directory will be used. The report is the same as the one of clc,
+paths are absolute as the server does not share the work directory of the client.
+Protocol: the client sends a request as one JSON object on a line, with key 'op' and the parameters of the
+operation. The server answers a JSON header line, {"ok": true, "size": N} followed by N bytes of payload, or
+{"ok": false, "error": message}, then closes the connection.
+"""
+__author__ = 'jim'
+
+import json
+import os
+import socket
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp',
+                           'clc-{}.sock'.format(os.getuid() if hasattr(os, 'getuid') else 'server'))
+
+
+class ServerError(Exception):
+    """
+    Error answered by the server.
+    """
+
+
+def request(op, socket_path=SOCKET_PATH, **params):
+    """
+    Send request 'op' with 'params' to the server listening on 'socket_path', return the payload bytes. Raise
+    ServerError if the server answers an error, OSError if it can not be reached.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(dict(params, op=op)).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            header = json.loads(f.readline() or b'{}')
+            if not header.get('ok'):
+                raise ServerError(header.get('error', 'connection closed by server'))
+            payload = f.read(header['size'])
+    if len(payload) != header['size']:
+        raise ServerError('connection closed by server')
+    return payload
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Ask the count server for the report of a directory or file.')
+    parser.add_argument('dof', nargs='?', default=os.getcwd(), metavar='dir_or_file',
+                        help='directory or file to count, default is current work directory')
+    parser.add_argument('--socket', default=SOCKET_PATH, metavar='PATH',
+                        help='socket of the server, default is {}'.format(SOCKET_PATH))
+    parser.add_argument('-f', '--format', choices=('csv', 'jsonl', 'text'),
+                        help='report format, default is text, or according to extension of the output file')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write report to FILE instead of standard output')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--roots', action='store_true', help='list the trees kept by the server')
+    group.add_argument('--drop', action='store_true', help='make the server forget the tree of dir_or_file')
+    group.add_argument('--stop', action='store_true', help='stop the server')
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        ext = os.path.splitext(args.output)[1][1:].lower() if args.output else ''
+        fmt = ext if ext in ('csv', 'jsonl') else 'text'
+    try:
+        if args.roots:
+            payload = request('roots', args.socket)
+        elif args.drop:
+            payload = request('drop', args.socket, path=os.path.abspath(args.dof))
+        elif args.stop:
+            payload = request('stop', args.socket)
+        else:
+            payload = request('report', args.socket, path=os.path.abspath(args.dof), format=fmt)
+    except (OSError, ServerError) as err:
+        sys.exit('client: {}'.format(err))
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(payload)
+    else:
+        sys.stdout.buffer.write(payload)
+        if payload and not payload.endswith(b'\n'):
+            sys.stdout.buffer.write(b'\n')
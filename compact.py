@@ -0,0 +1,393 @@
+"""
+Compact tree storage for very large trees: instead of a CounterTree and a Counter object per file, nodes are rows of
+typed arrays. NodeView and CounterView give the Tree and Counter API over a row, they are created on demand.
+"""
+__author__ = 'jim'
+
+import collections
+import heapq
+import os
+import weakref
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import clc
+from clc import Counter, CounterTree, DirBuilder, analyse_batch, analyse_file, set_batch_result
+
+_FIELDS = ('line_code', 'line_comment', 'line_blank', 'line_total')  # order of Counter.fields
+
+
+def _array_property(name):
+    def fget(self):
+        return getattr(self._tree, name)[self._i]
+
+    def fset(self, value):
+        getattr(self._tree, name)[self._i] = value
+    return property(fget, fset)
+
+
+class CounterView(Counter):
+    """
+    Counter of node 'index' of CompactTree 'tree', its fields are read from and written to the arrays.
+    """
+    __slots__ = ('_tree', '_i')
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._i = index
+
+    line_code = _array_property('line_code')
+    line_comment = _array_property('line_comment')
+    line_blank = _array_property('line_blank')
+    line_total = _array_property('line_total')
+
+    @property
+    def dof(self):
+        return self._tree.path(self._i)
+
+
+class NodeView(CounterTree):
+    """
+    Node 'index' of CompactTree 'tree'. The structure is read only, methods changing it raise AttributeError.
+    Views are cached as long as they are referenced, so the same node is always the same object and identity tests
+    of Tree work.
+    """
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._i = index
+
+    @property
+    def parent(self):
+        parent = self._tree.parents[self._i]
+        return None if parent < 0 else self._tree.node(parent)
+
+    @property
+    def children(self):
+        first = self._tree.first_children[self._i]
+        return [self._tree.node(i) for i in range(first, first + self._tree.child_counts[self._i])]
+
+    @property
+    def _index(self):
+        parent = self._tree.parents[self._i]
+        return 0 if parent < 0 else self._i - self._tree.first_children[parent]
+
+    @property
+    def counter(self):
+        return CounterView(self._tree, self._i)
+
+    @counter.setter
+    def counter(self, counter):
+        # 'node.counter += other' assigns the same counter back.
+        CounterView(self._tree, self._i).set_fields(counter.fields())
+
+    @property
+    def size(self):
+        return max(self._tree.sizes[self._i], 0)
+
+    @property
+    def name(self):
+        return os.path.split(self._tree.name(self._i))[1]
+
+    def is_leaf(self):
+        return not self._tree.child_counts[self._i]
+
+    def is_root(self):
+        return self._tree.parents[self._i] < 0
+
+    def largest(self, n, field='line_total', dirs=False):
+        if self._i > 1:
+            return CounterTree.largest(self, n, field, dirs)
+        # ROOT and top node: their descendants are all the following rows.
+        sizes, values = self._tree.sizes, getattr(self._tree, field)
+        numbers = (i for i in range(self._i + 1, len(self._tree)) if (sizes[i] < 0) == dirs)
+        return [self._tree.node(i) for i in heapq.nlargest(n, numbers, key=values.__getitem__)]
+
+    def __str__(self):
+        return '{} - {}'.format(self.name, self.counter)
+
+
+class CompactTree:
+    """
+    Nodes are numbered, node 0 is ROOT, and each node is a row of the arrays:
+    - parents: number of the parent node, -1 for ROOT.
+    - first_children, child_counts: children of a node are numbered consecutively, added by one append_children.
+    - sizes: file size in bytes, -1 for directories.
+    - name_offsets: name of node i is names[name_offsets[i]:name_offsets[i + 1]] in utf-8, the path of a node
+      is the join of the names from the top node, whose name is the path given to the builder.
+    - line_code, line_comment, line_blank, line_total: the counter.
+    As a node is always added after its parent, all descendants of a node have greater numbers, so sums are done by
+    one reverse pass over the arrays.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.parents = array('q')
+        self.first_children = array('q')
+        self.child_counts = array('q')
+        self.sizes = array('q')
+        self.name_offsets = array('q', [0])
+        self.names = bytearray()
+        for field in _FIELDS:
+            setattr(self, field, array('q'))
+        self._views = weakref.WeakValueDictionary()
+        self._append(-1, 'ROOT', -1)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def _append(self, parent, name, size):
+        self.parents.append(parent)
+        self.first_children.append(0)
+        self.child_counts.append(0)
+        self.sizes.append(size)
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.name_offsets.append(len(self.names))
+        for field in _FIELDS:
+            getattr(self, field).append(0)
+
+    def append_children(self, parent, entries):
+        """
+        Add all children of node 'parent' from 'entries' of (name, size), size is -1 for directories. Return the
+        number of the first child.
+        """
+        first = len(self)
+        self.first_children[parent] = first
+        self.child_counts[parent] = len(entries)
+        for name, size in entries:
+            self._append(parent, name, size)
+        return first
+
+    def name(self, i):
+        return self.names[self.name_offsets[i]:self.name_offsets[i + 1]].decode('utf-8', 'surrogateescape')
+
+    def path(self, i):
+        if i == 0:
+            return 'ROOT'
+        names = []
+        while i > 0:
+            names.append(self.name(i))
+            i = self.parents[i]
+        return os.path.join(*reversed(names))
+
+    def node(self, i=0):
+        """
+        Return the NodeView of node i.
+        """
+        view = self._views.get(i)
+        if view is None:
+            view = NodeView(self, i)
+            self._views[i] = view
+        return view
+
+    def files(self):
+        """
+        Return numbers of file nodes in increasing order.
+        """
+        return array('q', (i for i, size in enumerate(self.sizes) if size >= 0))
+
+    def prune(self):
+        """
+        Remove directories without valid files, as DirBuilder.setup does. Nodes are renumbered by one forward pass,
+        children of a node stay consecutive.
+        """
+        count = len(self)
+        sizes, parents = self.sizes, self.parents
+        keep = bytearray(count)
+        keep[0] = 1
+        for i in range(count - 1, 0, -1):
+            if keep[i] or sizes[i] >= 0:
+                keep[i] = 1
+                keep[parents[i]] = 1
+
+        old = {name: getattr(self, name) for name in ('parents', 'sizes', 'name_offsets', 'names') + _FIELDS}
+        self.clear()
+        new_numbers = array('q', [0]) * count
+        for i in range(1, count):
+            if not keep[i]:
+                continue
+            parent = new_numbers[old['parents'][i]]
+            new_numbers[i] = len(self)
+            if not self.child_counts[parent]:
+                self.first_children[parent] = len(self)
+            self.child_counts[parent] += 1
+            name = old['names'][old['name_offsets'][i]:old['name_offsets'][i + 1]]
+            self._append(parent, name.decode('utf-8', 'surrogateescape'), old['sizes'][i])
+            for field in _FIELDS:
+                getattr(self, field)[-1] = old[field][i]
+
+    def sum_up(self, cbk=None):
+        """
+        Sum counters of files up to their ancestors by one reverse pass, counters of directories are reset first.
+        cbk is called with each node once its counter is complete, return value indicates go on or not.
+        """
+        fields = [getattr(self, field) for field in _FIELDS]
+        for i, size in enumerate(self.sizes):
+            if size < 0:
+                for values in fields:
+                    values[i] = 0
+        parents = self.parents
+        for i in range(len(self) - 1, -1, -1):
+            if cbk is not None and not cbk(self.node(i)):
+                return False
+            parent = parents[i]
+            if parent >= 0:
+                for values in fields:
+                    values[parent] += values[i]
+        return True
+
+    def analysed(self, files, jobs=1, cache=None, batch_size=clc.CALC_BATCH_SIZE, analyse=analyse_file, dedup=None,
+                 stats=None):
+        """
+        Generate (number, analysed counter) of file nodes 'files' in order. Counters are only created for the
+        batches in progress. With 'jobs' > 1, batches are analysed by a pool of processes, at most 2 * jobs batches
+        ahead of the consumer, and timed there for stats.CountStats 'stats' if given, otherwise by 'analyse'. Files
+        found in ResultCache 'cache' are not analysed, nor copies found by dedup.ContentIndex 'dedup' of a file
+        coming before them.
+        """
+        executor = None
+        if jobs > 1:
+            executor = ProcessPoolExecutor(max_workers=jobs, initializer=clc._init_worker,
+                                           initargs=(clc.MMAP_THRESHOLD,))
+        pending = collections.deque()
+        try:
+            for start in range(0, len(files), batch_size):
+                numbers = files[start:start + batch_size]
+                counters = [Counter(self.path(i)) for i in numbers]
+                missing = [counter for counter in counters if (dedup is None or not dedup.is_copy(counter)) and
+                           (cache is None or not cache.lookup(counter))]
+                if executor is None:
+                    for counter in missing:
+                        analyse(counter)
+                    pending.append((numbers, counters, missing, None))
+                else:
+                    future = executor.submit(analyse_batch, missing, analyse_file, stats is not None)
+                    pending.append((numbers, counters, missing, future))
+                while len(pending) > (2 * jobs if executor else 0):
+                    yield from self._finish(pending.popleft(), cache, dedup, stats)
+            while pending:
+                yield from self._finish(pending.popleft(), cache, dedup, stats)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    @staticmethod
+    def _finish(batch, cache, dedup, stats):
+        numbers, counters, missing, future = batch
+        if future is not None:
+            for counter, result in zip(missing, future.result()):
+                set_batch_result(counter, result, stats)
+        if cache is not None:
+            for counter in missing:
+                cache.store(counter)
+        if dedup is not None:
+            for counter in counters:
+                if dedup.is_copy(counter):
+                    dedup.lookup(counter)
+                else:
+                    dedup.store(counter)
+        return zip(numbers, counters)
+
+    def calc(self, cbk=None, jobs=1, cache=None, analyse=analyse_file, dedup=None, stats=None):
+        """
+        Analyse all files, then sum them up. cbk is called with each node as calc of CounterTree does, return value
+        indicates go on or not. With 'jobs' > 1, files are recorded into stats.CountStats 'stats', if given.
+        """
+        fields = [getattr(self, field) for field in _FIELDS]
+        for i, counter in self.analysed(self.files(), jobs, cache, analyse=analyse, dedup=dedup, stats=stats):
+            for values, value in zip(fields, counter.fields()):
+                values[i] = value
+            if cbk is not None and not cbk(self.node(i)):
+                return False
+        if cbk is None:
+            return self.sum_up()
+        return self.sum_up(lambda node: self.sizes[node._i] >= 0 or cbk(node))  # files were already reported.
+
+
+class CompactDirBuilder(DirBuilder):
+    """
+    DirBuilder storing its tree in a CompactTree, self.tree is the NodeView of ROOT. It walks and filters files in
+    the same way, the resulting tree is the same.
+    """
+    def __init__(self, directory_or_file, jobs=1, cache=None, stats=None, walk_filter=None, dedup=None):
+        DirBuilder.__init__(self, directory_or_file, jobs, cache, stats, walk_filter, dedup)
+        self.compact = CompactTree()
+        self.tree = self.compact.node(0)
+
+    def setup(self):
+        with self.phase('walk'):
+            self._setup_compact()
+
+    def _setup_compact(self):
+        compact = self.compact
+        compact.clear()
+        self.tree = compact.node(0)
+        dof = self.dof
+        size = self._stat_top(dof)
+        if size is not None:
+            if self._is_valid(os.path.basename(dof)):
+                compact.append_children(0, [(dof, size)])
+            return
+
+        stack = [(compact.append_children(0, [(dof, -1)]), dof)]
+        while stack:
+            i, directory = stack.pop()
+            entries = self._list_dir(directory)
+            first = compact.append_children(i, [(os.path.basename(path), -1 if size is None else size)
+                                                for path, size in entries])
+            for j, (path, size) in enumerate(entries):
+                if size is None:
+                    stack.append((first + j, path))
+        compact.prune()
+
+    def reindex(self):
+        pass  # no path index, see find.
+
+    def find(self, path):
+        """
+        Return the NodeView of 'path', or None. There is no path index, to keep the tree compact: names are matched
+        from the top node down, which costs O(depth * children per directory).
+        """
+        for candidate in self._candidates(path):
+            i = self._find(os.path.normpath(candidate))
+            if i is not None:
+                return self.compact.node(i)
+        return None
+
+    def _find(self, path):
+        compact = self.compact
+        top = os.path.normpath(self.dof)
+        if not compact.child_counts[0]:
+            return None
+        if path == top:
+            return 1
+        if top == os.curdir and not os.path.isabs(path) and path != os.pardir and \
+                not path.startswith(os.pardir + os.sep):
+            names = path.split(os.sep)
+        elif path.startswith(os.path.join(top, '')):
+            names = path[len(os.path.join(top, '')):].split(os.sep)
+        else:
+            return None
+        i = 1
+        for name in names:
+            first = compact.first_children[i]
+            for j in range(first, first + compact.child_counts[i]):
+                if compact.name(j) == name:
+                    i = j
+                    break
+            else:
+                return None
+        return i
+
+    def calc(self):
+        analyse = analyse_file if self.stats is None else self.stats.wrap(analyse_file)
+        jobs, cache, dedup = self.jobs or os.cpu_count(), self.cache, self.dedup
+        if self.archive is not None:
+            # members are analysed from the archive, in this process.
+            analyse, jobs, cache, dedup = self.analyse_function(), 1, None, None
+        compact = self.compact
+        if dedup is not None:
+            with self.phase('dedup'):
+                dedup.build((compact.path(i), compact.sizes[i]) for i in compact.files())
+        with self.phase('calc'):
+            return compact.calc(cbk=self.cbk_analyse, jobs=jobs, cache=cache, analyse=analyse, dedup=dedup,
+                                stats=self.stats)
@@ -0,0 +1,140 @@
+"""
+Content deduplication within a count: files of identical content, like packages vendored in several places, are
+analysed only once.
+"""
+__author__ = 'jim'
+
+import hashlib
+import threading
+
+HASH_CHUNK_SIZE = 1 << 20  # bytes hashed at once
+TOP_N = 10  # number of duplicated contents listed by ContentIndex.report
+
+
+def _digest(path, chunk_size=HASH_CHUNK_SIZE):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.digest()
+
+
+class ContentIndex:
+    """
+    Groups of files of identical content, found by build before the analysis:
+    - files are grouped by size first, a file whose size is unique can not have a copy and is never read.
+    - files sharing their size are hashed, and the ones of the same (size, hash) are copies of the same content.
+    The first file of a group, in the order given to build, is analysed, the others get its fields through lookup.
+    lookup, store and wrap work as the ones of cache.ResultCache, so it's used by calc in the same way.
+    """
+    def __init__(self):
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.hits = 0
+        self._keys = {}  # path -> (size, digest), of files having a copy
+        self._groups = {}  # (size, digest) -> paths of copies, in order given to build
+        self._fields = {}  # (size, digest) -> fields of its first analysed copy
+        self._lock = threading.Lock()
+
+    def build(self, files):
+        """
+        Find copies among 'files', an iterable of (path, size) in the order the files are going to be analysed.
+        """
+        self._keys.clear()
+        self._groups.clear()
+        self._fields.clear()
+        by_size = {}
+        for path, size in files:
+            by_size.setdefault(size, []).append(path)
+
+        for size, paths in by_size.items():
+            if len(paths) < 2:
+                continue
+            for path in paths:
+                if size:
+                    try:
+                        digest = _digest(path)
+                    except OSError:
+                        continue  # it will fail in analysis as well.
+                    self.hashed_files += 1
+                    self.hashed_bytes += size
+                else:
+                    digest = b''
+                self._groups.setdefault((size, digest), []).append(path)
+
+        for key, paths in list(self._groups.items()):
+            if len(paths) < 2:
+                del self._groups[key]  # same size only.
+            else:
+                for path in paths:
+                    self._keys[path] = key
+
+    def is_copy(self, counter):
+        """
+        Tell whether the file of counter is a copy of a file coming before it, so it needs no analysis.
+        """
+        key = self._keys.get(counter.dof)
+        return key is not None and self._groups[key][0] != counter.dof
+
+    def lookup(self, counter):
+        """
+        Fill counter with the fields of a copy already analysed. Return True if found, otherwise False and counter
+        is untouched.
+        """
+        key = self._keys.get(counter.dof)
+        if key is None:
+            return False
+        with self._lock:
+            fields = self._fields.get(key)
+            if fields is None:
+                return False
+            self.hits += 1
+        counter.set_fields(fields)
+        return True
+
+    def store(self, counter):
+        """
+        Keep the fields of an analysed counter for its copies.
+        """
+        key = self._keys.get(counter.dof)
+        if key is not None:
+            with self._lock:
+                self._fields.setdefault(key, counter.fields())
+
+    def wrap(self, analyse):
+        """
+        Return an analyse function for CounterTree.calc, which only calls 'analyse' on the first file of a content.
+        """
+        def dedup_analyse(counter):
+            if not self.lookup(counter):
+                analyse(counter)
+                self.store(counter)
+        return dedup_analyse
+
+    def duplicates(self):
+        """
+        Return [(paths, fields)] of each content having copies and analysed, the most duplicated lines first.
+        """
+        result = [(paths, self._fields[key]) for key, paths in self._groups.items() if key in self._fields]
+        result.sort(key=lambda item: (len(item[0]) - 1) * item[1][3], reverse=True)
+        return result
+
+    def report(self, line_total=None, top_n=TOP_N):
+        """
+        Text telling how many files and lines come from duplicate content, i.e. from all copies but one of each
+        content, and listing the 'top_n' contents with most duplicate lines. 'line_total' is the total of the count,
+        to show the share of duplicate lines.
+        """
+        duplicates = self.duplicates()
+        copies = sum(len(paths) - 1 for paths, _ in duplicates)
+        lines = sum((len(paths) - 1) * fields[3] for paths, fields in duplicates)
+        share = ' ({:.1%} of {})'.format(lines / line_total, line_total) if line_total else ''
+        result = ['{} contents with copies, {} duplicate files, {} duplicate lines{}, {} files hashed, {:.1f} MB'
+                  .format(len(duplicates), copies, lines, share, self.hashed_files, self.hashed_bytes / (1 << 20))]
+        for paths, fields in duplicates[:top_n]:
+            result.append('  {} lines x {} copies:'.format(fields[3], len(paths)))
+            result += ['    {}'.format(path) for path in paths]
+        return '\n'.join(result)
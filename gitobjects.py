@@ -0,0 +1,443 @@
+"""
+Count the tree of a commit straight from the object database of a local git repository, without a checkout. Loose
+and packed objects are read, deltas are resolved, and the counts are memoized per blob SHA, so files unchanged
+between commits are only analysed once.
+"""
+__author__ = 'jim'
+
+import bisect
+import io
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from clc import DirBuilder, analyse_stream
+
+_OBJ_COMMIT, _OBJ_TREE, _OBJ_BLOB, _OBJ_TAG, _OBJ_OFS_DELTA, _OBJ_REF_DELTA = 1, 2, 3, 4, 6, 7
+_TYPE_NAMES = {_OBJ_COMMIT: b'commit', _OBJ_TREE: b'tree', _OBJ_BLOB: b'blob', _OBJ_TAG: b'tag'}
+_IDX_MAGIC = b'\377tOc'
+_READ_CHUNK = 64 << 10  # compressed bytes fed at once to zlib
+_DELTA_BASE_CACHE_SIZE = 256  # delta bases kept per pack
+_MODE_TREE = b'40000'
+_MODE_FILES = (b'100644', b'100755', b'100664')
+_REV_SUFFIXES = re.compile(r'(?:[~^][0-9]*)*$')
+_REV_SUFFIX = re.compile(r'([~^])([0-9]*)')
+
+
+class GitError(ValueError):
+    pass
+
+
+def _apply_delta(base, delta):
+    """
+    Return object built from 'base' by git delta 'delta'.
+    """
+    def varint(pos):
+        value = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value, pos
+
+    _, pos = varint(0)  # size of base
+    size, pos = varint(pos)
+    result = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy from base
+            offset = length = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    length |= delta[pos] << (8 * i)
+                    pos += 1
+            result += base[offset:offset + (length or 0x10000)]
+        elif op:
+            # insert
+            result += delta[pos:pos + op]
+            pos += op
+        else:
+            raise GitError('invalid delta')
+    if len(result) != size:
+        raise GitError('delta result size mismatch')
+    return bytes(result)
+
+
+class _Pack:
+    """
+    A pack file and its version 2 index, both memory mapped.
+    """
+    def __init__(self, idx_path):
+        with open(idx_path, 'rb') as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._idx[:4] != _IDX_MAGIC or struct.unpack_from('>I', self._idx, 4)[0] != 2:
+            raise GitError('unsupported pack index "{}"'.format(idx_path))
+        self._fanout = struct.unpack_from('>256I', self._idx, 8)
+        self.count = self._fanout[255]
+        self._names = 8 + 256 * 4
+        self._offsets = self._names + self.count * (20 + 4)
+        self._large_offsets = self._offsets + self.count * 4
+        with open(idx_path[:-4] + '.pack', 'rb') as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._bases = {}  # offset -> (type, data) of recent delta bases
+        self._lock = threading.Lock()
+
+    def _name(self, i):
+        start = self._names + i * 20
+        return self._idx[start:start + 20]
+
+    def find(self, sha):
+        """
+        Return offset of object 'sha' (20 bytes) in the pack, or None.
+        """
+        lo = self._fanout[sha[0] - 1] if sha[0] else 0
+        hi = self._fanout[sha[0]]
+        names = _IndexNames(self, lo, hi)
+        i = bisect.bisect_left(names, sha)
+        if i == len(names) or names[i] != sha:
+            return None
+        i += lo
+        offset = struct.unpack_from('>I', self._idx, self._offsets + i * 4)[0]
+        if offset & 0x80000000:
+            offset = struct.unpack_from('>Q', self._idx, self._large_offsets + (offset & 0x7fffffff) * 8)[0]
+        return offset
+
+    def _inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        chunks = []
+        while not decompressor.eof:
+            chunk = self._pack[pos:pos + _READ_CHUNK]
+            if not chunk:
+                raise GitError('truncated pack')
+            pos += len(chunk)
+            chunks.append(decompressor.decompress(chunk))
+        data = b''.join(chunks)
+        if len(data) != size:
+            raise GitError('object size mismatch in pack')
+        return data
+
+    def read(self, offset, repository):
+        """
+        Return (type, data) of the object at 'offset', with deltas resolved.
+        """
+        with self._lock:
+            cached = self._bases.get(offset)
+        if cached is not None:
+            return cached
+        pack = self._pack
+        byte = pack[offset]
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        pos = offset + 1
+        while byte & 0x80:
+            byte = pack[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+
+        if obj_type == _OBJ_OFS_DELTA:
+            byte = pack[pos]
+            pos += 1
+            base_offset = byte & 0x7f
+            while byte & 0x80:
+                byte = pack[pos]
+                pos += 1
+                base_offset = ((base_offset + 1) << 7) | (byte & 0x7f)
+            base_type, base = self.read(offset - base_offset, repository)
+        elif obj_type == _OBJ_REF_DELTA:
+            base_type, base = repository.read_object(pack[pos:pos + 20].hex())
+            pos += 20
+        else:
+            return obj_type, self._inflate(pos, size)
+
+        result = base_type, _apply_delta(base, self._inflate(pos, size))
+        with self._lock:
+            if len(self._bases) >= _DELTA_BASE_CACHE_SIZE:
+                self._bases.pop(next(iter(self._bases)))
+            self._bases[offset] = result
+        return result
+
+
+class _IndexNames:
+    """
+    Sequence of the object names of a pack index in [lo, hi), for bisect without copying them.
+    """
+    def __init__(self, pack, lo, hi):
+        self._pack = pack
+        self._lo = lo
+        self._len = hi - lo
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        return self._pack._name(self._lo + i)
+
+
+class Repository:
+    """
+    Read only access to the objects and references of the local git repository of working tree or git directory
+    'path'. Only SHA-1 repositories are supported.
+    """
+    def __init__(self, path):
+        git_dir = os.path.join(path, '.git')
+        if os.path.isfile(git_dir):
+            # a linked work tree or submodule, '.git' tells where the git directory is.
+            with open(git_dir) as f:
+                line = f.read().strip()
+            if not line.startswith('gitdir:'):
+                raise GitError('"{}" is not a git repository'.format(path))
+            git_dir = os.path.join(path, line[len('gitdir:'):].strip())
+        elif not os.path.isdir(git_dir):
+            git_dir = path
+        self.git_dir = git_dir
+        common_dir = git_dir
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir')) as f:
+                common_dir = os.path.join(git_dir, f.read().strip())
+        self.common_dir = common_dir
+        self.objects_dir = os.path.join(common_dir, 'objects')
+        if not os.path.isdir(self.objects_dir):
+            raise GitError('"{}" is not a git repository'.format(path))
+        self._packs = None
+
+    def _load_packs(self):
+        packs = []
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        if os.path.isdir(pack_dir):
+            for name in sorted(os.listdir(pack_dir)):
+                if name.endswith('.idx') and os.path.isfile(os.path.join(pack_dir, name[:-4] + '.pack')):
+                    packs.append(_Pack(os.path.join(pack_dir, name)))
+        self._packs = packs
+
+    def read_object(self, sha):
+        """
+        Return (type, data) of object 'sha' given in hex, type is one of the _OBJ_ constants.
+        """
+        path = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        try:
+            with open(path, 'rb') as f:
+                raw = zlib.decompress(f.read())
+        except FileNotFoundError:
+            pass
+        else:
+            header, _, data = raw.partition(b'\0')
+            type_name = header.split(b' ', 1)[0]
+            for obj_type, name in _TYPE_NAMES.items():
+                if name == type_name:
+                    return obj_type, data
+            raise GitError('unknown object type of {}'.format(sha))
+
+        if self._packs is None:
+            self._load_packs()
+        binary = bytes.fromhex(sha)
+        for pack in self._packs:
+            offset = pack.find(binary)
+            if offset is not None:
+                return pack.read(offset, self)
+        raise GitError('object {} not found'.format(sha))
+
+    def _read_ref(self, name):
+        """
+        Return SHA of reference 'name', like 'HEAD' or 'refs/heads/master', or None.
+        """
+        for _ in range(10):  # symbolic references
+            for directory in (self.git_dir, self.common_dir):
+                try:
+                    with open(os.path.join(directory, name)) as f:
+                        value = f.read().strip()
+                    break
+                except OSError:
+                    continue
+            else:
+                return self._packed_refs().get(name)
+            if not value.startswith('ref:'):
+                return value
+            name = value[len('ref:'):].strip()
+        return None
+
+    def _packed_refs(self):
+        refs = {}
+        try:
+            with open(os.path.join(self.common_dir, 'packed-refs')) as f:
+                for line in f:
+                    if line[0] not in '#^' and ' ' in line:
+                        sha, name = line.split()
+                        refs[name] = sha
+        except OSError:
+            pass
+        return refs
+
+    def resolve(self, rev):
+        """
+        Return SHA of the commit of 'rev': a full or abbreviated SHA, HEAD, a branch, a tag or a full reference name,
+        followed by any '~N' and '^N' suffixes to go to ancestors. Annotated tags are followed to their commit.
+        """
+        match = _REV_SUFFIXES.search(rev)
+        name, suffixes = rev[:match.start()], rev[match.start():]
+        for ref in (name, 'refs/' + name, 'refs/tags/' + name, 'refs/heads/' + name, 'refs/remotes/' + name):
+            sha = self._read_ref(ref)
+            if sha:
+                break
+        else:
+            sha = self._expand(name)
+        obj_type, data = self.read_object(sha)
+        while obj_type == _OBJ_TAG:
+            sha = data.split(b'\n', 1)[0].split()[1].decode()
+            obj_type, data = self.read_object(sha)
+        if obj_type != _OBJ_COMMIT:
+            raise GitError('"{}" is not a commit'.format(rev))
+
+        for op, number in _REV_SUFFIX.findall(suffixes):
+            number = 1 if number == '' else int(number)
+            if op == '~':
+                # N-th generation ancestor by first parents.
+                steps = [0] * number
+            else:
+                # N-th parent, '^0' is the commit itself.
+                steps = [number - 1] if number else []
+            for index in steps:
+                parents = self.commit_parents(sha)
+                if index >= len(parents):
+                    raise GitError('"{}" has no such ancestor'.format(rev))
+                sha = parents[index]
+        return sha
+
+    def commit_parents(self, commit_sha):
+        _, data = self.read_object(commit_sha)
+        header = data.split(b'\n\n', 1)[0]
+        return [line.split()[1].decode() for line in header.split(b'\n') if line.startswith(b'parent ')]
+
+    def _expand(self, prefix):
+        """
+        Return the SHA starting with hex 'prefix', looked up in loose and packed objects.
+        """
+        prefix = prefix.lower()
+        if len(prefix) < 4 or any(c not in '0123456789abcdef' for c in prefix):
+            raise GitError('unknown revision "{}"'.format(prefix))
+        if len(prefix) == 40:
+            return prefix
+        found = set()
+        try:
+            found.update(prefix[:2] + name for name in os.listdir(os.path.join(self.objects_dir, prefix[:2]))
+                         if name.startswith(prefix[2:]))
+        except OSError:
+            pass
+        if self._packs is None:
+            self._load_packs()
+        low = bytes.fromhex(prefix[:len(prefix) // 2 * 2])
+        for pack in self._packs:
+            names = _IndexNames(pack, 0, pack.count)
+            i = bisect.bisect_left(names, low)
+            while i < len(names) and names[i].hex().startswith(prefix):
+                found.add(names[i].hex())
+                i += 1
+        if len(found) != 1:
+            raise GitError('{} revision "{}"'.format('ambiguous' if found else 'unknown', prefix))
+        return found.pop()
+
+    def commit_tree(self, commit_sha):
+        _, data = self.read_object(commit_sha)
+        return data.split(b'\n', 1)[0].split()[1].decode()
+
+    def tree_entries(self, tree_sha):
+        """
+        Return [(mode, name, sha)] of tree 'tree_sha', mode and name as bytes, sha in hex.
+        """
+        obj_type, data = self.read_object(tree_sha)
+        if obj_type != _OBJ_TREE:
+            raise GitError('{} is not a tree'.format(tree_sha))
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(b' ', pos)
+            nul = data.index(b'\0', space)
+            entries.append((data[pos:space], data[space + 1:nul], data[nul + 1:nul + 21].hex()))
+            pos = nul + 21
+        return entries
+
+
+class BlobCounts:
+    """
+    Memo of Counter fields per blob SHA, to share between the counts of several commits.
+    """
+    def __init__(self):
+        self._fields = {}
+        self.hits = 0
+        self.misses = 0
+
+    def analyse(self, repository, sha, counter):
+        """
+        Fill counter with the counts of blob 'sha'. Return number of bytes read, 0 if it was memoized.
+        """
+        fields = self._fields.get(sha)
+        if fields is not None:
+            self.hits += 1
+            counter.set_fields(fields)
+            return 0
+        self.misses += 1
+        _, data = repository.read_object(sha)
+        analyse_stream(counter, io.BytesIO(data))
+        self._fields[sha] = counter.fields()
+        return len(data)
+
+
+class GitDirBuilder(DirBuilder):
+    """
+    DirBuilder of the tree of commit 'rev' in Repository 'repository'. The top node is named after rev, paths of
+    nodes are rev/path/in/tree. Files are analysed from their blobs through the BlobCounts 'blob_counts', which may
+    be shared by several builders. Files are always analysed in the current process, sizes of files are unknown
+    and left to 0, symbolic links and submodules are skipped.
+    """
+    def __init__(self, repository, rev, blob_counts=None, stats=None, walk_filter=None):
+        DirBuilder.__init__(self, rev.replace('/', '-'), stats=stats, walk_filter=walk_filter)
+        self.repository = repository
+        self.rev = rev
+        self.blob_counts = BlobCounts() if blob_counts is None else blob_counts
+        self._trees = {}  # directory path -> tree sha
+        self._blobs = {}  # file path -> blob sha
+
+    def _stat_top(self, directory_or_file):
+        try:
+            commit = self.repository.resolve(self.rev)
+        except GitError as err:
+            raise ValueError(str(err))
+        self._trees = {directory_or_file: self.repository.commit_tree(commit)}
+        self._blobs = {}
+        return None
+
+    def _list_dir(self, directory):
+        result = []
+        keep = None if self.walk_filter is None else self.walk_filter.matcher(directory)
+        for mode, name, sha in self.repository.tree_entries(self._trees[directory]):
+            name = name.decode('utf-8', 'surrogateescape')
+            path = os.path.join(directory, name)
+            if mode == _MODE_TREE:
+                if keep is None or keep(name, True):
+                    self._trees[path] = sha
+                    result.append((path, None))
+            elif mode in _MODE_FILES and self._is_valid(name) and (keep is None or keep(name, False)):
+                self._blobs[path] = sha
+                result.append((path, 0))
+        return result
+
+    def analyse_function(self):
+        def analyse_blob(counter):
+            # bytes read are returned, so stats do not stat the file on disk.
+            return self.blob_counts.analyse(self.repository, self._blobs[counter.dof], counter)
+        return analyse_blob if self.stats is None else self.stats.wrap(analyse_blob)
+
+    def calc(self):
+        with self.phase('calc'):
+            self.tree.calc(cbk=self.cbk_analyse, analyse=self.analyse_function())
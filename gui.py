@@ -5,64 +5,323 @@ from tkinter.messagebox import *
 from tkinter.filedialog import *
 from tkinter.ttk import *
 import clc
+import client
+import functools
+import io
 import obsqueue
+import os
+import pipeline
+import report
+import shard
+import stats
 import threading
+import time
+import watch
 
 ROOT_ITEM = ''
+LAZY_OPEN_LEVELS = 1  # in lazy mode, only nodes up to this depth get their children items at once.
+EVT_TICK = 10  # ms between two evt_q processing ticks
+EVT_BUDGET = 0.008  # seconds of each tick evt_q processing may take, the rest is left to Tk.
+WATCH_TIMEOUT = 0.5  # seconds the watch mode waits for changes before checking the stop request again
 
+# unbounded: build joins the worker thread in main thread, a worker blocked on a full queue would never return.
+# The worker puts at most one merged event per tick anyway, see GuiDirBuilder.
 evt_q = obsqueue.ObsQueue()
 
 
 class GuiDirBuilder(clc.DirBuilder):
+    """
+    Callbacks from the worker thread only record what changed, under a lock, and schedule one do_update_ctv event
+    when there was nothing pending. So whatever the count speed, the main thread handles at most one event per
+    evt_q processing tick, and updates each item once with the latest values of its node. An event applies changes
+    for EVT_BUDGET at most, the others are left for the next one.
+    """
     def __init__(self, ctv):
         # ctv is the CounterTreeView instance
         clc.DirBuilder.__init__(self, '')
         self.ctv = ctv
+        self._lock = threading.Lock()
+        self._changes = []  # (parent, node) to insert or (None, node) to delete, in order of happening.
+        self._dirty = {}  # nodes whose counter changed, as an ordered set.
+
+    def _schedule(self):
+        # must be called with self._lock held.
+        if not self._changes and not self._dirty:
+            evt_q.put_merged(self, self.do_update_ctv)
 
     def cbk_analyse(self, node):
         # this method is called from worker thread.
         if self.ctv.evt_stop_count.is_set():
             return False  # stop
-        evt_q.put(self.do_update_ctv, node)  # schedule process
+        with self._lock:
+            self._schedule()
+            self._dirty[node] = None
         return True  # go on
 
-    def do_update_ctv(self, node):
-        # it is called from main thread by evt_q consumer.
-        item = self.ctv.locate(node.locator())
-        self.ctv.item(item, values=(node.counter.line_total, node.counter.line_code,
-                                    node.counter.line_comment, node.counter.line_blank))
+    def cbk_discover(self, node):
+        # this method is called from worker thread in pipelined count and in watch mode.
+        with self._lock:
+            self._schedule()
+            self._changes.append((node.parent, node))
+
+    def cbk_remove(self, node):
+        # this method is called from worker thread in pipelined count and in watch mode.
+        with self._lock:
+            self._schedule()
+            self._changes.append((None, node))
+
+    def cbk_stats(self, count_stats):
+        # this method is called from worker thread after each phase of a count with stats.
+        evt_q.put_merged((self, 'stats'), self.ctv.show_status, count_stats.summary())
+
+    def reset_updates(self):
+        """
+        Drop pending updates, e.g. of a cancelled count.
+        """
+        with self._lock:
+            self._changes = []
+            self._dirty = {}
+
+    def do_update_ctv(self, budget=EVT_BUDGET):
+        # it is called from main thread by evt_q consumer. Changes left when 'budget' seconds are spent, e.g. the
+        # children of a very wide directory, are carried over to the next tick.
+        start_time = time.perf_counter()
+        with self._lock:
+            changes, self._changes = self._changes, []
+            dirty, self._dirty = list(self._dirty), {}
+
+        applied = updated = 0
+        for parent, node in changes:
+            if time.perf_counter() - start_time > budget:
+                break
+            if parent is None:
+                self.ctv.delete_node_item(node)
+            else:
+                self.ctv.add_node_item(parent, node)
+            applied += 1
+        if applied == len(changes):
+            for node in dirty:
+                if time.perf_counter() - start_time > budget:
+                    break
+                self.ctv.update_node_item(node)
+                updated += 1
+        if applied < len(changes) or updated < len(dirty):
+            with self._lock:
+                self._schedule()
+                self._changes[:0] = changes[applied:]  # before the changes recorded meanwhile.
+                left = dict.fromkeys(dirty[updated:])
+                left.update(self._dirty)
+                self._dirty = left
 
 
 class CounterTreeView(Treeview):
+    """
+    In lazy mode, only the top levels of the tree get items at first. Items of deeper nodes are inserted when their
+    parent item is opened, until then a placeholder item stands for them. Nodes without item keep their counters
+    in the model, the values are read when their item is inserted.
+    """
     def __init__(self, master, **kwargs):
         Treeview.__init__(self, master, **kwargs)
         self._dir_builder = GuiDirBuilder(ctv=self)
         self._worker_thread = None
+        self._watching = False
         self.evt_stop_count = threading.Event()
+        self.status = None  # StringVar showing stats of the count, if any.
+        self.lazy = False
+        self.items = {}  # tree node -> item
+        self._nodes = {}  # item -> tree node
+        self._collapsed = set()  # nodes whose children items are left to on_open.
+        self._placeholders = {}  # collapsed node -> its placeholder item
 
         columns = ('Total', 'Code', 'Comment', 'Blank')
         self.config(columns=columns, displaycolumns='#all')
         for c in columns:
             self.heading(c, text=c)
             self.column(c, width=80)
+        self.bind('<<TreeviewOpen>>', self.on_open)
 
     @property
     def tree(self):
         return self._dir_builder.tree
 
-    def _setup_items(self, node, item=ROOT_ITEM):
+    @staticmethod
+    def _values(node):
+        return node.counter.line_total, node.counter.line_code, node.counter.line_comment, node.counter.line_blank
+
+    @staticmethod
+    def _depth(node):
+        depth = 0
+        while not node.is_root():
+            node = node.parent
+            depth += 1
+        return depth
+
+    def _reset_items(self):
+        self.delete(*self.get_children(ROOT_ITEM))  # delete all items
+        self.items = {self.tree: ROOT_ITEM}
+        self._nodes = {ROOT_ITEM: self.tree}
+        self._collapsed = set()
+        self._placeholders = {}
+
+    def _insert_item(self, parent_item, node, depth):
         """
-        Fill descent items of 'item' according to descents of 'node'.
-        'item' should already exists, and should be the one mapping to 'node'.
+        Insert item of 'node' at 'depth' with its current values, at the end of 'parent_item'. Return the item.
         """
-        for child in reversed(node.children):
-            child_item = self.insert(item, 0, text=child.name)
-            self.item(child_item, open=True)
-            self._setup_items(child, child_item)
+        item = self.insert(parent_item, END, text=node.name, values=self._values(node))
+        self.items[node] = item
+        self._nodes[item] = node
+        if self.lazy and depth > LAZY_OPEN_LEVELS:
+            self._collapsed.add(node)
+            if not node.is_leaf():
+                self._placeholders[node] = self.insert(item, END, text='...')
+        else:
+            self.item(item, open=True)
+        return item
 
-    def build(self, dir_or_file):
+    def _setup_items(self, node, item=ROOT_ITEM, depth=0):
+        """
+        Fill descent items of 'item' according to descents of 'node', and map the new nodes to their items.
+        'item' should already exists, and should be the one mapping to 'node'. In lazy mode, collapsed nodes are not
+        descended. The walk uses an explicit stack, so the depth of the tree is not limited.
+        """
+        stack = [(node, item, depth)]
+        while stack:
+            node, item, depth = stack.pop()
+            for child in node.children:
+                child_item = self._insert_item(item, child, depth + 1)
+                if child not in self._collapsed:
+                    stack.append((child, child_item, depth + 1))
+
+    def add_node_item(self, parent, node):
+        """
+        Insert item of 'node' just added to 'parent' in the tree, unless parent has no item or is collapsed.
+        """
+        parent_item = self.items.get(parent)
+        if parent_item is None or node in self.items:
+            return
+        if parent in self._collapsed:
+            if parent not in self._placeholders:
+                self._placeholders[parent] = self.insert(parent_item, END, text='...')
+        else:
+            self._insert_item(parent_item, node, self._depth(node))
+
+    def delete_node_item(self, node):
+        """
+        Delete item of 'node' just removed from the tree, with the items of its descendants.
+        """
+        item = self.items.get(node)
+        if item is None:
+            return
+        self.delete(item)
+        for descendant in node.walker():
+            item = self.items.pop(descendant, None)
+            if item is not None:
+                del self._nodes[item]
+            self._collapsed.discard(descendant)
+            self._placeholders.pop(descendant, None)
+
+    def update_node_item(self, node):
+        item = self.items.get(node)
+        if item is not None:
+            self.item(item, values=self._values(node))
+
+    def on_open(self, event=None):
+        """
+        Fill children items of the opened item if it's collapsed.
+        """
+        item = self.focus()
+        self._expand(item, self._nodes.get(item))
+
+    def _expand(self, item, node):
+        if node not in self._collapsed:
+            return
+        self._collapsed.discard(node)
+        placeholder = self._placeholders.pop(node, None)
+        if placeholder is not None:
+            self.delete(placeholder)
+        depth = self._depth(node)
+        for child in list(node.children):
+            self._insert_item(item, child, depth + 1)
+
+    def jump_to(self, path):
+        """
+        Select and show the item of 'path', found by the path index of the builder, opening its ancestors. In lazy
+        mode, only the collapsed ancestors get their children items. Return False if path is not in the tree.
+        """
+        node = self._dir_builder.find(path)
+        if node is None:
+            return False
+        ancestors = []
+        parent = node.parent
+        while parent is not None and not parent.is_root():
+            ancestors.append(parent)
+            parent = parent.parent
+        for ancestor in reversed(ancestors):
+            item = self.items.get(ancestor)
+            if item is None:
+                return False
+            self._expand(item, ancestor)
+            self.item(item, open=True)
+        item = self.items.get(node)
+        if item is None:
+            return False  # not shown yet, e.g. just discovered by a pipelined count.
+        self.see(item)
+        self.selection_set(item)
+        self.focus(item)
+        return True
+
+    def _count_and_watch(self, count):
+        """
+        Worker thread of watch mode: count, then keep the tree up to date until evt_stop_count is set. Archives
+        are counted but not watched.
+        """
+        count()
+        if self.evt_stop_count.is_set() or self._dir_builder.archive is not None:
+            return
+        watcher = watch.TreeWatcher(self._dir_builder)
+        try:
+            watcher.run(self.evt_stop_count, WATCH_TIMEOUT)
+        finally:
+            watcher.close()
+
+    def show_status(self, text):
+        if self.status is not None:
+            self.status.set(text)
+
+    def _fetch(self, dir_or_file):
+        """
+        Worker thread of attached mode: get the tree from the count server, then show it from main thread.
+        """
+        try:
+            root = shard.load(io.BytesIO(client.request('shard', path=os.path.abspath(dir_or_file))))
+        except (OSError, ValueError, client.ServerError) as err:
+            evt_q.put(showerror, 'Error', 'Count server: {}'.format(err))
+            return
+        if not self.evt_stop_count.is_set():
+            evt_q.put(self._show_tree, root)
+
+    def _show_tree(self, root):
+        # it is called from main thread by evt_q consumer.
+        self._dir_builder.tree = root
+        self._dir_builder.reindex()
+        self._reset_items()
+        self._setup_items(root)
+
+    def build(self, dir_or_file, pipelined=False, watching=False, with_stats=False, attached=False):
+        """
+        In pipelined mode, items are added while the directories are walked, instead of after the walk.
+        In watch mode, the worker thread goes on after the count and updates the items of changed files, until next
+        build.
+        With stats, the time of each phase and the slowest file are shown in the status.
+        In attached mode, the tree is asked to the count server instead, see server.py, so nothing is counted in
+        this process. The server keeps it up to date, a new build shows the changes.
+        """
         if self._worker_thread and self._worker_thread.is_alive():
-            if askyesno('Info', 'Previous count is still running? Start new count immediately?\n '
+            if self._watching:
+                self.evt_stop_count.set()
+                self._worker_thread.join()
+                self.evt_stop_count.clear()
+            elif askyesno('Info', 'Previous count is still running? Start new count immediately?\n '
                                 'Choose YES to kill current count task and start new task.\n'
                                 'Choose NO to wait current task.') == YES:
                 self.evt_stop_count.set()
@@ -70,13 +329,30 @@ class CounterTreeView(Treeview):
                 self.evt_stop_count.clear()
             else:
                 return
+        self._dir_builder.reset_updates()
+        self._dir_builder.stats = stats.CountStats() if with_stats else None
+        self.show_status('')
+        if attached:
+            self._dir_builder.dof = os.path.abspath(dir_or_file)  # paths of the server tree are absolute.
+            self._watching = False
+            self._worker_thread = threading.Thread(target=self._fetch, args=(dir_or_file,), daemon=True)
+            self._worker_thread.start()
+            return
         try:
             self._dir_builder.dof = dir_or_file
-            self._dir_builder.setup()  # build directory/file tree
-            self.delete(*self.get_children(ROOT_ITEM))  # delete all items
-            self._setup_items(self._dir_builder.tree)  # setup new items
-            self._worker_thread = threading.Thread(target=self._dir_builder.calc, daemon=True)
-            self._worker_thread.start()  # do calc in worker thread
+            if pipelined:
+                target = pipeline.PipelinedCount(self._dir_builder).run  # walk and calc in worker thread
+            else:
+                self._dir_builder.setup()  # build directory/file tree
+                target = self._dir_builder.calc  # do calc in worker thread
+            self._reset_items()
+            if not pipelined:
+                self._setup_items(self._dir_builder.tree)  # setup new items
+            if watching:
+                target = functools.partial(self._count_and_watch, target)
+            self._watching = watching
+            self._worker_thread = threading.Thread(target=target, daemon=True)
+            self._worker_thread.start()
         except ValueError as err:
             showerror('Error', str(err))
 
@@ -117,17 +393,45 @@ class MainPanel(Frame):
 
         addr_container = Frame(self)
         self.dof = StringVar()
+        self.pipelined = BooleanVar()
+        self.lazy = BooleanVar()
+        self.watching = BooleanVar()
+        self.with_stats = BooleanVar()
+        self.attached = BooleanVar()
+        self.jump_path = StringVar()
+        self.status = StringVar()
+        ctv.status = self.status
         Button(addr_container, text='Save', command=self.on_save).pack(side=RIGHT)
         Button(addr_container, text='Count', command=self.on_count).pack(side=RIGHT)
+        Checkbutton(addr_container, text='Pipeline', variable=self.pipelined).pack(side=RIGHT)
+        Checkbutton(addr_container, text='Lazy', variable=self.lazy).pack(side=RIGHT)
+        Checkbutton(addr_container, text='Watch', variable=self.watching).pack(side=RIGHT)
+        Checkbutton(addr_container, text='Stats', variable=self.with_stats).pack(side=RIGHT)
+        Checkbutton(addr_container, text='Server', variable=self.attached).pack(side=RIGHT)
         Button(addr_container, text='Directory', command=self.on_dir).pack(side=RIGHT)
         Button(addr_container, text='File', command=self.on_file).pack(side=RIGHT)
         Entry(addr_container, textvariable=self.dof).pack(side=TOP, fill=X)
 
+        jump_container = Frame(self)
+        Button(jump_container, text='Jump', command=self.on_jump).pack(side=RIGHT)
+        jump_entry = Entry(jump_container, textvariable=self.jump_path)
+        jump_entry.bind('<Return>', lambda event: self.on_jump())
+        jump_entry.pack(side=TOP, fill=X)
+
         addr_container.pack(side=TOP, fill=X)
+        jump_container.pack(side=TOP, fill=X)
+        Label(self, textvariable=self.status, anchor=W).pack(side=BOTTOM, fill=X)
         trv_container.pack(expand=YES, fill=BOTH)
 
     def on_count(self):
-        self.ctv.build(self.dof.get())
+        self.ctv.lazy = self.lazy.get()
+        self.ctv.build(self.dof.get(), self.pipelined.get(), self.watching.get(), self.with_stats.get(),
+                       self.attached.get())
+
+    def on_jump(self):
+        path = self.jump_path.get()
+        if path and not self.ctv.jump_to(path):
+            showinfo('Info', '"{}" is not in the counted tree'.format(path))
 
     def on_dir(self):
         the_dir = askdirectory()
@@ -140,10 +444,12 @@ class MainPanel(Frame):
             self.dof.set(the_file)
 
     def on_save(self):
-        the_file = asksaveasfilename()
+        # report format follows the file extension.
+        the_file = asksaveasfilename(filetypes=[('Text tree', '*.txt'), ('JSON Lines', '*.jsonl'), ('CSV', '*.csv'),
+                                                ('All files', '*')])
         if the_file:
             with open(the_file, 'w') as f:
-                f.write(self.ctv.tree.text_tree())
+                report.write_report(self.ctv.tree, f, report.format_of(the_file))
 
 
 if __name__ == '__main__':
@@ -152,8 +458,8 @@ if __name__ == '__main__':
     MainPanel(root).pack(expand=YES, fill=BOTH)
 
     def event_handler():
-        evt_q.process(100)
-        root.after(10, event_handler)
+        evt_q.process(EVT_BUDGET)
+        root.after(EVT_TICK, event_handler)
 
     event_handler()  # start event handler.
 
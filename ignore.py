@@ -0,0 +1,262 @@
+"""
+Ignore rules applied while walking directories: exclude and include globs, .gitignore style rule files and a depth
+limit. Excluded directories are never listed.
+"""
+__author__ = 'jim'
+
+import os
+import re
+
+GIT_DIR = '.git'
+
+
+_GLOB_CHARS = re.compile(r'[*?\[\\]')
+
+
+def _translate_class(pattern, i):
+    """
+    Return (index of the closing ']', regular expression) of the [...] class starting at 'i' in a glob of .gitignore
+    syntax, or (-1, None) if it's not closed. A ']' just after '[' or '[!' is part of the class, a backslash escapes
+    the next character, e.g. in [\\]a] or [\\-], and only a bare trailing backslash is a literal one.
+    """
+    j, n = i + 1, len(pattern)
+    result = ['[']
+    if j < n and pattern[j] in '!^':
+        result.append('^')
+        j += 1
+    first = j
+    while j < n:
+        c = pattern[j]
+        if c == ']' and j > first:
+            result.append(']')
+            return j, ''.join(result)
+        if c == '\\' and j + 1 < n:
+            j += 1
+            result.append(re.escape(pattern[j]))
+        else:
+            result.append(c if c == '-' else re.escape(c))  # a '-' between two characters is a range.
+        j += 1
+    return -1, None
+
+
+def _translate(pattern):
+    """
+    Return regular expression of a glob of .gitignore syntax.
+    """
+    result = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            result.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[':
+            end, chars = _translate_class(pattern, i)
+            if end < 0:
+                result.append(re.escape(c))
+            else:
+                result.append(chars)
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            result.append(re.escape(pattern[i]))
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return ''.join(result)
+
+
+class _Patterns:
+    """
+    Patterns of a group of rules, each kept in the form matched fastest: plain names in a set, '*suffix' globs in
+    a tuple for str.endswith, other globs of a name in one regular expression, and globs of a path, which have a
+    '/', in another one. As directories are walked from top, a glob without '/' only needs to match the name of
+    an entry, its ancestors were matched before.
+    """
+    def __init__(self, patterns):
+        names = set()
+        suffixes = []
+        name_regexes = []
+        path_regexes = []
+        for pattern in patterns:
+            if pattern.startswith('**/') and '/' not in pattern[3:]:
+                pattern = pattern[3:]
+            if '/' in pattern:
+                path_regexes.append(_translate(pattern.lstrip('/')))
+            elif not _GLOB_CHARS.search(pattern):
+                names.add(pattern)
+            elif pattern.startswith('*') and not _GLOB_CHARS.search(pattern, 1):
+                suffixes.append(pattern[1:])
+            else:
+                name_regexes.append(_translate(pattern))
+        self.names = names
+        self.suffixes = tuple(suffixes)
+        self.name_regex = re.compile('|'.join(name_regexes)) if name_regexes else None
+        self.path_regex = re.compile('|'.join(path_regexes)) if path_regexes else None
+
+    def match(self, name, path):
+        return bool(name in self.names or (self.suffixes and name.endswith(self.suffixes)) or
+                    (self.name_regex is not None and self.name_regex.fullmatch(name)) or
+                    (self.path_regex is not None and self.path_regex.fullmatch(path)))
+
+
+class RuleSet:
+    """
+    Rules in .gitignore syntax, relative to directory 'base'. Consecutive rules of the same kind, ignoring or
+    re-including with '!', are compiled together, so matching a path costs about the same whatever the number of
+    rules. Groups are tried from the last one, as the last matching rule wins.
+    """
+    def __init__(self, base, lines):
+        self.base = base
+        self._groups = []  # (negated, patterns for any entry, patterns for directories only)
+        rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip('\r')
+            if not line.strip() or line.startswith('#'):
+                continue
+            line = line.rstrip(' ')
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            rules.append((negated, line.endswith('/'), line.rstrip('/')))
+
+        start = 0
+        for end in range(1, len(rules) + 1):
+            if end == len(rules) or rules[end][0] != rules[start][0]:
+                group = rules[start:end]
+                self._groups.append((group[0][0], _Patterns([p for _, dir_only, p in group if not dir_only]),
+                                     _Patterns([p for _, dir_only, p in group if dir_only])))
+                start = end
+        self._groups.reverse()
+
+    @classmethod
+    def from_file(cls, base, file_name):
+        """
+        Return RuleSet of rule file 'file_name' in directory 'base', or None if there is no such file.
+        """
+        try:
+            with open(os.path.join(base, file_name), encoding='utf-8', errors='surrogateescape') as f:
+                return cls(base, f.readlines())
+        except OSError:
+            return None
+
+    def __bool__(self):
+        return bool(self._groups)
+
+    def match(self, name, path, is_dir):
+        """
+        'path' of an entry named 'name' is relative to base with '/' separators. Return True if it's ignored, False
+        if it's re-included and None if no rule matches.
+        """
+        for negated, any_patterns, dir_patterns in self._groups:
+            if any_patterns.match(name, path) or (is_dir and dir_patterns.match(name, path)):
+                return not negated
+        return None
+
+
+def _prefix(directory, base):
+    """
+    Prefix of the paths of entries of 'directory' relative to its ancestor 'base', with '/' separators, both
+    normalized.
+    """
+    if directory == base:
+        return ''
+    if base == os.curdir:
+        relative = directory
+    else:
+        relative = directory[len(base.rstrip(os.sep)) + 1:]
+    return relative.replace(os.sep, '/') + '/'
+
+
+class WalkFilter:
+    """
+    Decide which entries of each directory under 'top' are walked:
+    - 'excludes': .gitignore style patterns relative to top, e.g. 'build/', '*_pb2.py' or '/docs'.
+    - 'includes': if any, only files matching one of these patterns are kept.
+    - 'rule_files': names of rule files, like '.gitignore', read in each directory walked. Their rules apply to the
+      directory and below, and win over the rules of upper directories and excludes.
+    - 'max_depth': directories deeper than max_depth levels under top are not walked, 0 keeps only files in top.
+    """
+    def __init__(self, top, excludes=(), includes=(), rule_files=(), max_depth=None):
+        self.top = os.path.normpath(top)
+        self.rule_files = tuple(rule_files)
+        self.max_depth = max_depth
+        excludes = list(excludes)
+        if GIT_DIR not in excludes and '.gitignore' in self.rule_files:
+            excludes.append(GIT_DIR + '/')
+        rule_set = RuleSet(self.top, excludes)
+        self._includes = RuleSet(self.top, includes) if includes else None
+        self._contexts = {self.top: (0, (rule_set,) if rule_set else ())}  # directory -> (depth, rule sets)
+        self._add_rule_files(self.top)
+
+    def _add_rule_files(self, directory):
+        depth, rule_sets = self._contexts[directory]
+        for file_name in self.rule_files:
+            rule_set = RuleSet.from_file(directory, file_name)
+            if rule_set:
+                rule_sets += (rule_set,)
+        self._contexts[directory] = depth, rule_sets
+
+    def _context(self, directory):
+        """
+        Return (depth, rule sets) of normalized 'directory', which is under top.
+        """
+        missing = []
+        while directory not in self._contexts:
+            missing.append(directory)
+            parent = os.path.dirname(directory) or os.curdir
+            if parent == directory:
+                raise ValueError('"{}" is not under "{}"'.format(missing[0], self.top))
+            directory = parent
+        depth, rule_sets = self._contexts[directory]
+        for directory in reversed(missing):
+            depth += 1
+            self._contexts[directory] = depth, rule_sets
+            self._add_rule_files(directory)
+            rule_sets = self._contexts[directory][1]
+        return depth, rule_sets
+
+    def matcher(self, directory):
+        """
+        Return a function keep(name, is_dir) telling whether an entry of 'directory' is walked, or None if all
+        entries are. Everything depending on the directory only is computed here once, so keep costs one regular
+        expression match per rule group.
+        """
+        directory = os.path.normpath(directory)
+        depth, rule_sets = self._context(directory)
+        if not rule_sets and self._includes is None and (self.max_depth is None or depth < self.max_depth):
+            return None
+        deep = self.max_depth is not None and depth >= self.max_depth
+        prefixes = [(rule_set, _prefix(directory, rule_set.base)) for rule_set in reversed(rule_sets)]
+        includes = self._includes
+        include_prefix = _prefix(directory, self.top)
+
+        def keep(name, is_dir):
+            if is_dir and deep:
+                return False
+            for rule_set, prefix in prefixes:
+                ignored = rule_set.match(name, prefix + name, is_dir)
+                if ignored is not None:
+                    if ignored:
+                        return False
+                    break
+            if not is_dir and includes is not None:
+                return bool(includes.match(name, include_prefix + name, False))
+            return True
+        return keep
+
+    def keeps(self, path, is_dir):
+        """
+        Tell whether 'path' under top is walked, its ancestors are supposed to be.
+        """
+        keep = self.matcher(os.path.dirname(os.path.normpath(path)))
+        return keep is None or keep(os.path.basename(path), is_dir)
@@ -4,70 +4,208 @@ Observer queue class
 __author__ = 'jim'
 
 
-import queue
+import collections
+import threading
 import time
 
 
+class _Event:
+    __slots__ = ('observer', 'args', 'kwargs', 'key', 'put_time')
+
+    def __init__(self, observer, args, kwargs, key=None):
+        self.observer = observer
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.put_time = time.perf_counter()
+
+
 class ObsQueue:
     instance_count = 0
-    the_instance = None
+    the_instance = None  # the first instance, several independent instances are allowed.
 
-    def __init__(self, process_in_main_thread=False):
+    def __init__(self, process_in_main_thread=False, maxsize=0):
         """
         process_in_main_thread: if yes, put will not put the action in the queue but immediately execute the action.
           it can be adjusted dynamically.
           Due to this design, whenever there is a second thread, the GUI in main thread should keep user from
           any modification, it becomes a pure observer. Under this design, some thread synchronous problem will
           be avoid.
+        maxsize: if > 0, the queue holds at most maxsize events, put blocks until the consumer makes room for it.
+          This back-pressure keeps a fast producer from flooding memory. put_merged does not block when it merges.
         """
-        self._q = queue.Queue()
+        self._events = collections.deque()
+        self._merged = {}  # key -> pending event put by put_merged
+        self._mutex = threading.Lock()
+        self._not_full = threading.Condition(self._mutex)
+        self._all_done = threading.Condition(self._mutex)
+        self._unfinished = 0  # events put but not processed yet
+        self.maxsize = maxsize
         self.process_in_main_thread = process_in_main_thread
-        ObsQueue.the_instance = self
+        self.reset_stats()
+        if ObsQueue.the_instance is None:
+            ObsQueue.the_instance = self
         ObsQueue.instance_count += 1
-        if ObsQueue.instance_count > 1:
-            raise RuntimeError('Class ObsQueue can have only one instance.')
+
+    def reset_stats(self):
+        """
+        Restart counters of stats.
+        """
+        with self._mutex:
+            self._stats_start = time.perf_counter()
+            self._enqueued = 0
+            self._merged_count = 0
+            self._dequeued = 0
+            self._max_depth = len(self._events)
+            self._total_latency = 0.0
+            self._max_latency = 0.0
+            self._blocked_time = 0.0
+
+    def stats(self):
+        """
+        Return a dict of counters since creation or last reset_stats:
+        - enqueued, merged, dequeued: number of events put, put_merged into a pending one, and processed.
+        - enqueue_rate, dequeue_rate: the same per second.
+        - depth, max_depth: number of pending events now and at most.
+        - avg_latency, max_latency: seconds from put to processing.
+        - blocked_time: seconds producers spent waiting for room in a full queue.
+        """
+        with self._mutex:
+            elapsed = max(time.perf_counter() - self._stats_start, 1e-9)
+            return {
+                'enqueued': self._enqueued,
+                'merged': self._merged_count,
+                'dequeued': self._dequeued,
+                'enqueue_rate': self._enqueued / elapsed,
+                'dequeue_rate': self._dequeued / elapsed,
+                'depth': len(self._events),
+                'max_depth': self._max_depth,
+                'avg_latency': self._total_latency / self._dequeued if self._dequeued else 0.0,
+                'max_latency': self._max_latency,
+                'blocked_time': self._blocked_time,
+            }
 
     def wait_sync(self):
         """
         wait until all previous event handled. Can be used to synchronous an event.
         """
-        self._q.join()
+        with self._all_done:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def _enqueue(self, event):
+        # must be called with self._mutex held.
+        if self.maxsize > 0 and len(self._events) >= self.maxsize:
+            start_time = time.perf_counter()
+            while len(self._events) >= self.maxsize:
+                self._not_full.wait()
+            self._blocked_time += time.perf_counter() - start_time
+        self._events.append(event)
+        self._unfinished += 1
+        self._enqueued += 1
+        self._max_depth = max(self._max_depth, len(self._events))
 
     def put(self, observer, *args, **kwargs):
         if self.process_in_main_thread:
             observer(*args, **kwargs)
         else:
-            item_to_put = (observer, args, kwargs)
-            self._q.put(item_to_put)
+            with self._mutex:
+                self._enqueue(_Event(observer, args, kwargs))
 
-    def process(self, timeout=None, print_trace=False):
+    def put_merged(self, key, observer, *args, **kwargs):
+        """
+        Same as put, but if an event put with the same key is still pending, it's replaced by this one, keeping its
+        place in the queue. Use it for events where only the latest matters, like showing a value.
+        """
+        if self.process_in_main_thread:
+            observer(*args, **kwargs)
+            return
+        with self._mutex:
+            event = self._merged.get(key)
+            if event is None:
+                event = _Event(observer, args, kwargs, key)
+                self._enqueue(event)
+                self._merged[key] = event
+            else:
+                event.observer, event.args, event.kwargs = observer, args, kwargs
+                self._merged_count += 1
+
+    def _take(self, count):
+        """
+        Take up to count pending events at once.
+        """
+        with self._mutex:
+            batch = []
+            now = time.perf_counter()
+            while self._events and len(batch) < count:
+                event = self._events.popleft()
+                if event.key is not None:
+                    del self._merged[event.key]
+                latency = now - event.put_time
+                self._total_latency += latency
+                self._max_latency = max(self._max_latency, latency)
+                batch.append(event)
+            self._dequeued += len(batch)
+            self._not_full.notify(len(batch))
+            return batch
+
+    def _done(self, count):
+        with self._mutex:
+            self._unfinished -= count
+            if not self._unfinished:
+                self._all_done.notify_all()
+
+    def _give_back(self, events):
+        """
+        Put events taken but not processed back to the front of the queue. An event replaced by a newer put_merged
+        meanwhile is dropped, the newer one has the latest arguments.
+        """
+        with self._mutex:
+            dropped = 0
+            for event in reversed(events):
+                if event.key is not None:
+                    if event.key in self._merged:
+                        dropped += 1
+                        continue
+                    self._merged[event.key] = event
+                self._events.appendleft(event)
+            self._dequeued -= len(events) - dropped
+            self._unfinished -= dropped
+            if not self._unfinished:
+                self._all_done.notify_all()
+
+    def process(self, timeout=None, print_trace=False, batch_size=64):
         """
         return time consumed.
+        timeout is the time budget in seconds, it's checked after each event, so that a caller calling it
+        periodically, e.g. from a GUI timer, keeps control. Events are taken from the queue batch_size at a time.
+        An exception raised by an observer propagates, the events after it are left in the queue.
         """
         start_time = time.perf_counter()
         while True:
-            try:
-                func, args, kwargs = self._q.get(block=False)
-            except queue.Empty:
+            batch = self._take(batch_size)
+            if not batch:
                 break
-            else:
+            for i, event in enumerate(batch):
                 if print_trace:
-                    print('call func "{}" with parameters {}, {}'.format(func, args, kwargs))
-                func(*args, **kwargs)
-                self._q.task_done()  # Put after func call. Because func is the task.
-                if timeout:
-                    if time.perf_counter() - start_time > timeout:
-                        break
+                    print('call func "{}" with parameters {}, {}'.format(event.observer, event.args, event.kwargs))
+                try:
+                    event.observer(*event.args, **event.kwargs)
+                except BaseException:
+                    self._give_back(batch[i + 1:])  # the rest of the batch stays pending, wait_sync does not hang.
+                    raise
+                finally:
+                    self._done(1)  # Put after func call. Because func is the task.
+                if timeout and time.perf_counter() - start_time > timeout:
+                    self._give_back(batch[i + 1:])
+                    return time.perf_counter() - start_time
 
         return time.perf_counter() - start_time
 
 
 if __name__ == '__main__':
     oq = ObsQueue()
-    try:
-        oq2 = ObsQueue()
-    except RuntimeError as err:
-        print(err)
+    oq2 = ObsQueue(maxsize=2)  # instances are independent.
 
     oq.put(lambda x: print(x), 1)
     oq.put(lambda x: print(x), x='hello')
@@ -76,7 +214,12 @@ if __name__ == '__main__':
     oq.put(lambda: time.sleep(1))
     oq.put(lambda: print('should not be printed in main thread.'))
     oq.process(0.5)
-    print(oq._q.qsize())
+    print(oq.stats()['depth'])
+
+    for i in range(5):
+        oq2.put_merged('progress', lambda x: print('progress', x), i)  # only 'progress 4' is printed.
+    oq2.process()
+    print(oq2.stats())
 
     import threading
     threading.Thread(target=oq.process, args=(), daemon=True).start()
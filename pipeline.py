@@ -0,0 +1,174 @@
+"""
+Pipelined count: the directory walk and the analysis of files overlap, instead of DirBuilder.setup walking the
+whole tree before DirBuilder.calc reads a single file.
+"""
+__author__ = 'jim'
+
+import os
+import queue
+import threading
+from clc import Counter, CounterTree
+
+QUEUE_SIZE = 256  # files discovered but not taken by an analysis thread yet
+_POLL_INTERVAL = 0.1  # seconds blocked threads wait before checking the stop request again
+
+
+class PipelinedCount:
+    """
+    Count of DirBuilder 'builder' in three stages:
+    - a walker thread lists directories with builder._list_dir, reports each listing, and feeds the files found
+      through a queue bounded by 'queue_size' to the analysis threads, so the walk can not run away from them.
+    - 'jobs' analysis threads analyse the files and report their fields.
+    - the calling thread, the only one touching the tree, adds nodes as listings arrive and finalizes a directory
+      as soon as all of its descendants are done: its counter is summed up, or it's removed if it has no valid
+      files. builder.cbk_analyse is called for each finalized node, builder.cbk_discover for each added node and
+      builder.cbk_remove for each removed directory.
+    The resulting tree is the same as setup followed by calc, only the order of cbk_analyse calls differs.
+    """
+    def __init__(self, builder, jobs=None, queue_size=QUEUE_SIZE):
+        """
+        jobs: number of analysis threads, default is builder.jobs, 0 means one per CPU.
+        Raise ValueError if builder.dof does not exist.
+        """
+        self.builder = builder
+        self._top_size = builder._stat_top(builder.dof)
+        if jobs is None:
+            jobs = builder.jobs
+        self.jobs = jobs or os.cpu_count()
+        self.analyse = builder.analyse_function()
+        self._files = queue.Queue(maxsize=queue_size)
+        self._events = queue.Queue()  # (kind, path, data) from walker and analysis threads
+        self._stop = threading.Event()
+        self._nodes = {}  # path -> node, of nodes not finalized yet
+        self._pending = {}  # directory node -> number of children not finalized yet
+
+    def _put_file(self, path):
+        while not self._stop.is_set():
+            try:
+                self._files.put(path, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _walk(self, top, is_dir):
+        try:
+            if not is_dir:
+                self._put_file(top)
+                return
+            stack = [top]
+            while stack and not self._stop.is_set():
+                directory = stack.pop()
+                entries = self.builder._list_dir(directory)
+                self._events.put(('list', directory, entries))
+                for path, size in entries:
+                    if size is None:
+                        stack.append(path)
+                    else:
+                        self._put_file(path)
+        except Exception as err:
+            self._events.put(('error', top, err))
+        finally:
+            for _ in range(self.jobs):
+                self._put_file(None)  # tell analysis threads to quit.
+
+    def _analyse(self):
+        while not self._stop.is_set():
+            try:
+                path = self._files.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if path is None:
+                break
+            counter = Counter(path)
+            try:
+                self.analyse(counter)
+            except Exception as err:
+                self._events.put(('error', path, err))
+            else:
+                self._events.put(('done', path, counter.fields()))
+
+    def _add_node(self, parent, path, size):
+        node = CounterTree(directory_or_file=path, size=size or 0)
+        parent.append_child(node)
+        self._nodes[path] = node
+        self.builder._index_node(node)
+        self.builder.cbk_discover(node)
+
+    def _on_list(self, directory, entries):
+        dir_node = self._nodes[directory]
+        self._pending[dir_node] = len(entries)
+        for path, size in entries:
+            self._add_node(dir_node, path, size)
+        if entries:
+            return True
+        return self._finalize(dir_node)
+
+    def _finalize(self, node):
+        """
+        Finalize node, then go on with its ancestors which have no pending children anymore. Return go on or not.
+        """
+        while True:
+            parent = node.parent
+            self._nodes.pop(node.counter.dof, None)
+            removed = False
+            if node in self._pending:
+                # it's a directory.
+                del self._pending[node]
+                if node.is_leaf() and parent is not None:
+                    parent.cut_child(node.index)
+                    self.builder._unindex_node(node)
+                    self.builder.cbk_remove(node)
+                    removed = True
+                else:
+                    for child in node.children:
+                        node.counter += child.counter
+            if not removed and not self.builder.cbk_analyse(node):
+                return False
+            if parent is None:
+                return True
+            self._pending[parent] -= 1
+            if self._pending[parent]:
+                return True
+            node = parent
+
+    def run(self):
+        """
+        Return go on or not, as calc does. With builder.stats, the whole count is timed as phase 'pipeline'.
+        """
+        with self.builder.phase('pipeline'):
+            return self._run()
+
+    def _run(self):
+        root = self.builder.tree
+        root.children.clear()
+        root.counter = Counter('ROOT')
+        self.builder.path_index.clear()
+        self._pending[root] = 1
+
+        top = self.builder.dof
+        size = self._top_size
+        if size is not None and not self.builder._is_valid(os.path.basename(top)):
+            return self._finalize(root)
+        self._add_node(root, top, size)
+
+        threads = [threading.Thread(target=self._walk, args=(top, size is None), daemon=True)]
+        threads += [threading.Thread(target=self._analyse, daemon=True) for _ in range(self.jobs)]
+        for thread in threads:
+            thread.start()
+        try:
+            go_on = True
+            while go_on and root in self._pending:
+                kind, path, data = self._events.get()
+                if kind == 'error':
+                    raise data
+                elif kind == 'list':
+                    go_on = self._on_list(path, data)
+                else:
+                    node = self._nodes[path]
+                    node.counter.set_fields(data)
+                    go_on = self._finalize(node)
+            return go_on
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,84 @@
+"""
+Report writers of a counted CounterTree. All of them stream nodes to a text file object, the whole report is never
+built in memory.
+"""
+__author__ = 'jim'
+
+import csv
+import json
+import os
+
+FIELDS = ('path', 'depth', 'is_file', 'total', 'code', 'comment', 'blank')
+PENDING_FIELDS = ('pending_files', 'pending_bytes')  # only reported for a partial count, see schedule.py
+
+
+def _rows(tree):
+    """
+    Generate (node, depth) in pre-order, the same order as text_tree.
+    """
+    stack = [(tree, 0)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        for child in reversed(node.children):
+            stack.append((child, depth + 1))
+
+
+def _record(node, depth):
+    counter = node.counter
+    return (counter.dof, depth, node.is_leaf() and not node.is_root(),
+            counter.line_total, counter.line_code, counter.line_comment, counter.line_blank)
+
+
+def write_text(tree, f):
+    tree.write_text_tree(f)
+
+
+def write_jsonl(tree, f):
+    """
+    One JSON object per line and per node, with keys of FIELDS, and of PENDING_FIELDS for partial nodes. In a
+    multi-language count, key 'languages' maps each language to its total, code, comment and blank lines.
+    """
+    for node, depth in _rows(tree):
+        record = dict(zip(FIELDS, _record(node, depth)))
+        if node.languages is not None:
+            record['languages'] = {name: dict(zip(FIELDS[3:], (counter.line_total, counter.line_code,
+                                                               counter.line_comment, counter.line_blank)))
+                                   for name, counter in sorted(node.languages.items())}
+        if node.pending_files:
+            record.update(zip(PENDING_FIELDS, (node.pending_files, node.pending_bytes)))
+        f.write(json.dumps(record))
+        f.write('\n')
+
+
+def write_csv(tree, f):
+    """
+    A header line of FIELDS, then one line per node. PENDING_FIELDS are added if the count is partial.
+    """
+    writer = csv.writer(f, lineterminator='\n')
+    partial = bool(tree.pending_files)
+    writer.writerow(FIELDS + PENDING_FIELDS if partial else FIELDS)
+    for node, depth in _rows(tree):
+        if partial:
+            writer.writerow(_record(node, depth) + (node.pending_files, node.pending_bytes))
+        else:
+            writer.writerow(_record(node, depth))
+
+
+WRITERS = {
+    'text': write_text,
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+}
+
+
+def write_report(tree, f, fmt='text'):
+    WRITERS[fmt](tree, f)
+
+
+def format_of(file_name):
+    """
+    Report format according to the extension of file_name, 'text' if it's not known.
+    """
+    ext = os.path.splitext(file_name)[1][1:].lower()
+    return ext if ext in WRITERS else 'text'
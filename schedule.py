@@ -0,0 +1,188 @@
+"""
+Size ordered count with a deadline: files are analysed largest first, and when the deadline comes the count stops
+with a consistent partial tree, whose directories sum the files analysed so far.
+"""
+__author__ = 'jim'
+
+import multiprocessing
+import queue
+import time
+import clc
+from clc import analyse_batch, analyse_file, set_batch_result
+
+SCHEDULE_BATCH_BYTES = 1 << 18  # files are sent to a worker process in batches of about this many bytes
+
+
+def _batches(nodes, batch_bytes=SCHEDULE_BATCH_BYTES, batch_size=clc.CALC_BATCH_SIZE):
+    """
+    Group file nodes 'nodes', largest first, in batches of about 'batch_bytes' and at most 'batch_size' files, so
+    a large file is a batch by itself and small files do not cost a round trip each.
+    """
+    batch, size = [], 0
+    for node in nodes:
+        batch.append(node)
+        size += node.size
+        if size >= batch_bytes or len(batch) >= batch_size:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+class ScheduledCount:
+    """
+    Count of CounterTree 'tree', as set up by DirBuilder.setup, analysing its files largest first until 'deadline',
+    a time.monotonic() value, or to the end if it's None. Large files are started first, so with 'jobs' processes
+    they do not end up alone at the end of the count, the small files fill the gaps.
+    When the deadline comes, worker processes are terminated, even in the middle of a file. With jobs = 1, files are
+    analysed by 'analyse' in the current process, which can only stop between two files.
+    After run, file nodes not analysed and their directories have pending_files and pending_bytes set, the other
+    nodes are complete, and the counters of directories are the sums of their files analysed.
+    ResultCache 'cache' and dedup.ContentIndex 'dedup' are used as calc_parallel does when jobs > 1, with jobs = 1
+    'analyse' should go through them already. Worker processes analyse files by 'worker_analyse', which must be
+    picklable, and time them for stats.CountStats 'stats' if given, with jobs = 1 'analyse' should be timed already.
+    """
+    def __init__(self, tree, deadline=None, jobs=1, analyse=analyse_file, cache=None, dedup=None,
+                 worker_analyse=analyse_file, stats=None):
+        self.tree = tree
+        self.deadline = deadline
+        self.jobs = jobs
+        self.analyse = analyse
+        self.cache = cache
+        self.dedup = dedup
+        self.worker_analyse = worker_analyse
+        self.stats = stats
+        self.files = 0
+        self.analysed = 0
+        self.bytes_analysed = 0
+        self.pending_bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def complete(self):
+        return self.analysed == self.files
+
+    def _expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def run(self, cbk=None):
+        """
+        Analyse files, then sum them up. cbk is called with each file node once analysed, in analysis order, return
+        value indicates go on or not. Return True if all files were analysed.
+        """
+        start = time.monotonic()
+        nodes = [node for node in self.tree.walker() if node.is_leaf() and not node.is_root()]
+        nodes.sort(key=lambda node: node.size, reverse=True)
+        self.files = len(nodes)
+        done = set()
+        if self.jobs > 1:
+            self._run_parallel(nodes, done, cbk)
+        else:
+            for node in nodes:
+                if self._expired():
+                    break
+                self.analyse(node.counter)
+                done.add(node)
+                if cbk is not None and not cbk(node):
+                    break
+        self.elapsed = time.monotonic() - start
+        self._sum_up(done)
+        return self.complete
+
+    def _run_parallel(self, nodes, done, cbk):
+        cache, dedup = self.cache, self.dedup
+        copies = []
+        if dedup is not None:
+            copies = [node for node in nodes if dedup.is_copy(node.counter)]
+            nodes = [node for node in nodes if not dedup.is_copy(node.counter)]
+        if cache is not None:
+            missing = []
+            for node in nodes:
+                if cache.lookup(node.counter):
+                    done.add(node)
+                    if dedup is not None:
+                        dedup.store(node.counter)
+                else:
+                    missing.append(node)
+            nodes = missing
+
+        # a multiprocessing pool, unlike a ProcessPoolExecutor, can terminate workers busy with a file.
+        pool = multiprocessing.Pool(self.jobs, initializer=clc._init_worker, initargs=(clc.MMAP_THRESHOLD,))
+        results = queue.Queue()  # (batch, results or exception), put by the result handler thread of the pool
+        try:
+            pending = 0
+            for batch in _batches(nodes):
+                pool.apply_async(analyse_batch, ([node.counter for node in batch], self.worker_analyse,
+                                                 self.stats is not None),
+                                 callback=lambda batch_results, batch=batch: results.put((batch, batch_results)),
+                                 error_callback=lambda err, batch=batch: results.put((batch, err)))
+                pending += 1
+            while pending:
+                timeout = None if self.deadline is None else self.deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    batch, batch_results = results.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending -= 1
+                if isinstance(batch_results, BaseException):
+                    raise batch_results
+                go_on = True
+                for node, result in zip(batch, batch_results):
+                    set_batch_result(node.counter, result, self.stats)
+                    done.add(node)
+                    if cache is not None:
+                        cache.store(node.counter)
+                    if dedup is not None:
+                        dedup.store(node.counter)
+                    if cbk is not None and go_on:
+                        go_on = cbk(node)
+                if not go_on:
+                    break
+        finally:
+            pool.terminate()
+
+        # copies of contents analysed, the others are left pending.
+        for node in copies:
+            if dedup.lookup(node.counter):
+                done.add(node)
+
+    def _sum_up(self, done):
+        """
+        Sum counters of analysed files up to their directories, and pending work of the others, by one pass in
+        post-order. Counters of directories are the ones of setup, i.e. zero.
+        """
+        self.analysed = len(done)
+        self.bytes_analysed = 0
+        for node in self.tree.walker(pre_order=False):
+            if node.is_leaf() and not node.is_root():
+                if node in done:
+                    self.bytes_analysed += node.size
+                else:
+                    node.pending_files = 1
+                    node.pending_bytes = node.size
+            parent = node.parent
+            if parent is not None:
+                parent.counter += node.counter
+                if node.pending_files:
+                    parent.pending_files += node.pending_files
+                    parent.pending_bytes += node.pending_bytes
+        self.pending_bytes = self.tree.pending_bytes
+
+    def remaining_seconds(self):
+        """
+        Estimate of the time the pending files would take, at the rate of bytes analysed by this run. None if
+        nothing was analysed.
+        """
+        if not self.bytes_analysed:
+            return None
+        return self.pending_bytes * self.elapsed / self.bytes_analysed
+
+    def summary(self):
+        if self.complete:
+            return '{} files analysed in {:.2f}s'.format(self.files, self.elapsed)
+        remaining = self.remaining_seconds()
+        return 'partial count: {} of {} files analysed in {:.2f}s, {} files of {:.1f} MB left{}'.format(
+            self.analysed, self.files, self.elapsed, self.files - self.analysed, self.pending_bytes / (1 << 20),
+            '' if remaining is None else ', about {:.1f}s more'.format(remaining))
@@ -0,0 +1,211 @@
+"""
+Resident count server: counted trees of one or more directories or files are kept in memory, and report requests
+are answered over a Unix domain socket, see client.py for the protocol. A tree is counted on the first request of
+its path, later requests only apply the changes found since, as watch mode does: with inotify, or with --poll by
+comparing the stat of each directory and file, only changed files are analysed again.
+cmd line usage:  server [--socket PATH] [--poll] [dir_or_file ...]
+The given directories or files are counted at start, others on demand. The server runs until Ctrl-C or a stop
+request.
+Requests, with their parameters:
+- report (path, format): the report of path in format text, jsonl or csv.
+- shard (path): the tree of path as a binary shard, see shard.py.
+- roots: paths of the trees kept, one per line.
+- drop (path): forget the tree of path.
+- stop: stop the server.
+"""
+__author__ = 'jim'
+
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import clc
+import report
+import shard
+import watch
+from client import SOCKET_PATH
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+class _Root:
+    """
+    Counted tree of 'path', with the TreeWatcher keeping it up to date. An archive can not be watched, it's counted
+    again when its stat changed.
+    """
+    def __init__(self, path, use_inotify=True):
+        self.builder = _QuietBuilder(path)
+        self.builder.setup()
+        self.builder.calc()
+        self.watcher = None
+        self.identity = None
+        if self.builder.archive is None:
+            self.watcher = watch.TreeWatcher(self.builder, use_inotify)
+        else:
+            self.identity = watch._identity(os.stat(path))
+
+    def revalidate(self):
+        """
+        Apply changes found since last call.
+        """
+        if self.watcher is not None:
+            self.watcher.drain()
+            return
+        try:
+            identity = watch._identity(os.stat(self.builder.dof))
+        except OSError:
+            raise ValueError('Directory or file "{}" invalid'.format(self.builder.dof))
+        if identity != self.identity:
+            self.builder.setup()
+            self.builder.calc()
+            self.identity = identity
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():
+            return  # e.g. a server checking whether this one is alive.
+        try:
+            params = json.loads(line)
+            op = params.pop('op', None)
+            payload = self.server.answer(op, **params)
+        except Exception as err:
+            header = {'ok': False, 'error': str(err) or type(err).__name__}
+            self.wfile.write(json.dumps(header).encode('utf-8') + b'\n')
+            return
+        try:
+            self.wfile.write(json.dumps({'ok': True, 'size': len(payload)}).encode('utf-8') + b'\n')
+            if payload:
+                self.wfile.write(payload)
+        finally:
+            if op == 'stop':
+                self.server.shutdown()  # once answered, as the process exits then, even if the client left.
+
+
+class CountServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server listening on Unix domain socket 'socket_path'. Requests are handled by a thread each, trees are counted
+    and revalidated one at a time. inotify is used if available, unless 'use_inotify' is False.
+    Raise OSError if another server listens on the socket, a socket file left by a dead server is replaced.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=SOCKET_PATH, use_inotify=True):
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(socket_path)
+                except OSError:
+                    os.unlink(socket_path)
+                else:
+                    raise OSError('a server already listens on "{}"'.format(socket_path))
+        # the socket is created by bind with mode 0o600, it's never open to other users, even briefly.
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        self.socket_path = socket_path
+        self.use_inotify = use_inotify
+        self._roots = {}  # normalized path -> _Root
+        self._lock = threading.Lock()
+
+    def root(self, path):
+        """
+        Return the DirBuilder of 'path' with its tree up to date, counting it if it's not kept yet. Raise ValueError
+        if path does not exist.
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            root = self._roots.get(path)
+            if root is None:
+                root = _Root(path, self.use_inotify)
+                self._roots[path] = root
+            else:
+                root.revalidate()
+            return root.builder
+
+    def drop(self, path):
+        with self._lock:
+            root = self._roots.pop(os.path.normpath(path), None)
+        if root is not None:
+            root.close()
+
+    def answer(self, op, **params):
+        """
+        Return the payload answering request 'op' with 'params'. Raise ValueError for a bad request.
+        """
+        if op == 'report':
+            builder = self.root(params['path'])
+            fmt = params.get('format', 'text')
+            if fmt not in report.WRITERS:
+                raise ValueError('unknown format "{}"'.format(fmt))
+            f = io.StringIO()
+            with self._lock:
+                report.write_report(builder.tree, f, fmt)
+            return f.getvalue().encode('utf-8', 'surrogateescape')
+        if op == 'shard':
+            builder = self.root(params['path'])
+            f = io.BytesIO()
+            with self._lock:
+                shard.dump([builder.tree], f)
+            return f.getvalue()
+        if op == 'roots':
+            with self._lock:
+                return ''.join(path + '\n' for path in self._roots).encode('utf-8', 'surrogateescape')
+        if op == 'drop':
+            self.drop(params['path'])
+            return b''
+        if op == 'stop':
+            return b''
+        raise ValueError('unknown request "{}"'.format(op))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        with self._lock:
+            roots, self._roots = self._roots, {}
+        for root in roots.values():
+            root.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Keep counted trees in memory and serve reports of them.')
+    parser.add_argument('dofs', nargs='*', metavar='dir_or_file', help='directories or files to count at start')
+    parser.add_argument('--socket', default=SOCKET_PATH, metavar='PATH',
+                        help='socket to listen on, default is {}'.format(SOCKET_PATH))
+    parser.add_argument('--poll', action='store_true',
+                        help='find changes by stat of directories and files instead of inotify')
+    args = parser.parse_args()
+
+    try:
+        server = CountServer(args.socket, use_inotify=not args.poll)
+    except OSError as err:
+        parser.error(str(err))
+    try:
+        for dof in args.dofs:
+            try:
+                server.root(os.path.abspath(dof))
+            except ValueError as err:
+                print(err, file=sys.stderr)
+        print('serving on {}'.format(args.socket), file=sys.stderr)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
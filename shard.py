@@ -0,0 +1,258 @@
+"""
+Result shards: a counted CounterTree saved with its structure and counters, so counts of parts of a large volume,
+done by several processes or machines, can be merged into one tree and reported without reading any source file.
+cmd line usage:  shard [-f FORMAT] [-o FILE] [--save SHARD] shard [shard ...]
+The shards are merged, the merged tree is reported as clc does, and saved as a shard with --save.
+A shard keeps the plain counters only, so partial counts of clc --deadline and counts by language of clc
+--languages are refused rather than saved without their pending files or breakdown.
+"""
+__author__ = 'jim'
+
+import json
+import os
+import struct
+from clc import Counter, CounterTree
+
+MAGIC = b'CLS\x01'
+JSON_FORMAT = 'clc-shard'
+JSON_VERSION = 1
+# depth, size, line_code, line_comment, line_blank, line_total, name length
+_RECORD = struct.Struct('<IqqqqqI')
+_JSON_EXTENSIONS = ('.json', '.jsonl')
+
+
+def format_of(file_name):
+    """
+    Shard format according to the extension of file_name: 'json' for .json and .jsonl, otherwise 'binary'.
+    """
+    return 'json' if os.path.splitext(file_name)[1].lower() in _JSON_EXTENSIONS else 'binary'
+
+
+def _records(trees):
+    """
+    Generate (depth, name, size, fields) of the nodes under each ROOT node of 'trees' in pre-order. Nodes at depth 0
+    are the counted tops, their name is their whole path, other nodes are named relative to their parent.
+    """
+    for tree in trees:
+        stack = [(child, 0) for child in reversed(tree.children)]
+        while stack:
+            node, depth = stack.pop()
+            yield depth, node.counter.dof if depth == 0 else node.name, node.size, node.counter.fields()
+            for child in reversed(node.children):
+                stack.append((child, depth + 1))
+
+
+def check(trees):
+    """
+    Raise ValueError if a tree under the ROOT nodes 'trees' carries more than the counters a shard keeps: files not
+    analysed of a partial count, or a breakdown by language.
+    """
+    for tree in trees:
+        for top in tree.children:
+            if top.pending_files:
+                raise ValueError('"{}" is a partial count, it can not be saved as a shard'.format(top.counter.dof))
+            if top.languages is not None:
+                raise ValueError('"{}" is counted by language, it can not be saved as a shard'.format(
+                    top.counter.dof))
+
+
+def dump(trees, f, fmt='binary'):
+    """
+    Write the counted trees under each ROOT node of 'trees' to binary file object 'f', in format 'binary' or 'json'.
+    - binary: MAGIC, then per node _RECORD followed by the utf-8 name.
+    - json: a header line {"format": JSON_FORMAT, "version": JSON_VERSION}, then per node a line
+      [depth, name, size, line_code, line_comment, line_blank, line_total].
+    Nodes are written one by one in pre-order, the shard is never built in memory. Raise ValueError, before
+    writing anything, for trees refused by check.
+    """
+    check(trees)
+    if fmt == 'json':
+        f.write(json.dumps({'format': JSON_FORMAT, 'version': JSON_VERSION}).encode('ascii') + b'\n')
+        for depth, name, size, fields in _records(trees):
+            f.write(json.dumps([depth, name, size, *fields]).encode('ascii') + b'\n')
+    else:
+        f.write(MAGIC)
+        for depth, name, size, fields in _records(trees):
+            name_bytes = name.encode('utf-8', 'surrogateescape')
+            f.write(_RECORD.pack(depth, size, *fields, len(name_bytes)))
+            f.write(name_bytes)
+
+
+def _binary_records(data):
+    pos = len(MAGIC)
+    while pos < len(data):
+        depth, size, code, comment, blank, total, name_len = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        if pos + name_len > len(data):
+            raise struct.error('truncated name')
+        yield depth, data[pos:pos + name_len].decode('utf-8', 'surrogateescape'), size, (code, comment, blank, total)
+        pos += name_len
+
+
+def _json_records(lines):
+    for line in lines:
+        if line.strip():
+            depth, name, size, *fields = json.loads(line)
+            yield depth, name, size, tuple(fields)
+
+
+def load(f, source='shard'):
+    """
+    Read a shard written by dump from binary file object 'f', its format is recognized. Return the ROOT node of
+    the tree, with a child per counted top. Raise ValueError if it's not a valid shard, named 'source' in the error.
+    """
+    head = f.read(len(MAGIC))
+    if head == MAGIC:
+        records = _binary_records(head + f.read())
+    else:
+        try:
+            header = json.loads(head + f.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('format') != JSON_FORMAT:
+            raise ValueError('"{}" is not a shard'.format(source))
+        if header.get('version') != JSON_VERSION:
+            raise ValueError('Shard "{}" has unknown version {}'.format(source, header.get('version')))
+        records = _json_records(f)
+
+    root = CounterTree('ROOT')
+    parents = [root]  # parents[depth] is the parent of next node at depth
+    try:
+        for depth, name, size, fields in records:
+            if depth >= len(parents):
+                raise ValueError('bad depth {}'.format(depth))
+            parent = parents[depth]
+            node = CounterTree(os.path.join(parent.counter.dof, name) if depth else name, size)
+            node.counter.set_fields(fields)
+            parent.children.append(node)  # as append_child, without the O(depth) check, the shard is a new tree.
+            node.parent = parent
+            node._index = len(parent.children) - 1
+            del parents[depth + 1:]
+            parents.append(node)
+    except (ValueError, TypeError, struct.error) as err:
+        raise ValueError('Shard "{}" invalid: {}'.format(source, err))
+    aggregate(root)
+    return root
+
+
+def aggregate(tree):
+    """
+    Sum counters of files up to all directories of 'tree', by one pass in post-order. Counters of files are kept,
+    the ones of directories are computed again.
+    """
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+    for node in reversed(nodes):
+        if node.children:
+            counter = Counter(node.counter.dof)
+            for child in node.children:
+                counter += child.counter
+            node.counter = counter
+
+
+def merge(roots):
+    """
+    Graft the counted tops of ROOT nodes 'roots', as returned by load, into one tree and return its ROOT. Its top is
+    the common directory of all tops, directories between it and the tops are added. When a top is inside a part
+    already merged, e.g. a subtree counted again, it replaces the node of the same path, so later shards win.
+    Counters are aggregated once at the end, the whole merge costs O(number of nodes). The nodes of 'roots' are
+    moved to the merged tree. Raise ValueError if the tops have absolute and relative paths.
+    """
+    tops = [top for root in roots for top in list(root.children)]
+    merged = CounterTree('ROOT')
+    if not tops:
+        return merged
+    paths = [os.path.normpath(top.counter.dof) for top in tops]
+    try:
+        base = os.path.commonpath(paths) if len(tops) > 1 else paths[0]
+    except ValueError:
+        raise ValueError('Shards of absolute and relative paths can not be merged')
+    if not base:
+        base = os.curdir  # relative tops without common directory.
+
+    index = {}  # normalized path -> node of the merged tree
+
+    def add_index(node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            index[os.path.normpath(node.counter.dof)] = node
+            stack.extend(node.children)
+
+    def remove_index(node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            index.pop(os.path.normpath(node.counter.dof), None)
+            stack.extend(node.children)
+
+    def directory(path):
+        missing = []
+        while path not in index:
+            missing.append(path)
+            path = os.path.dirname(path) or os.curdir
+        node = index[path]
+        for path in reversed(missing):
+            child = CounterTree(path)
+            node.append_child(child)
+            index[path] = child
+            node = child
+        return node
+
+    # the base directory is replaced by the top of the same path, if any.
+    merged.append_child(CounterTree(base))
+    index[base] = merged.children[0]
+    for top, path in zip(tops, paths):
+        top.parent.cut_child(top.index)
+        old = index.get(path)
+        if old is None:
+            directory(os.path.dirname(path) or os.curdir).append_child(top)
+        else:
+            remove_index(old)
+            parent, position = old.parent, old.index
+            parent.cut_child(position)
+            parent.add_child(top, position)
+        add_index(top)
+    aggregate(merged)
+    return merged
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import report
+    parser = argparse.ArgumentParser(description='Merge result shards and report the merged tree.')
+    parser.add_argument('shards', nargs='+', metavar='shard', help='shard written by clc --shard, or by --save')
+    parser.add_argument('-f', '--format', choices=sorted(report.WRITERS),
+                        help='report format, default is text, or according to extension of the output file')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write report to FILE instead of standard output')
+    parser.add_argument('--save', metavar='SHARD', help='save the merged tree as a shard, json if SHARD ends with '
+                                                        '.json or .jsonl, otherwise binary')
+    args = parser.parse_args()
+
+    roots = []
+    for file_name in args.shards:
+        try:
+            with open(file_name, 'rb') as f:
+                roots.append(load(f, file_name))
+        except (OSError, ValueError) as err:
+            parser.error(str(err))
+    try:
+        tree = merge(roots)
+    except ValueError as err:
+        parser.error(str(err))
+
+    if args.save:
+        with open(args.save, 'wb') as f:
+            dump([tree], f, format_of(args.save))
+    if args.output:
+        with open(args.output, 'w') as f:
+            report.write_report(tree, f, args.format or report.format_of(args.output))
+    else:
+        report.write_report(tree, sys.stdout, args.format or 'text')
+        if (args.format or 'text') == 'text':
+            print('')
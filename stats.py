@@ -0,0 +1,146 @@
+"""
+Opt-in instrumentation of a count: wall and CPU time of each phase, and latency and bytes of each analysed file.
+"""
+__author__ = 'jim'
+
+import heapq
+import os
+import threading
+import time
+
+TOP_N = 10  # number of slowest files and directories kept
+
+
+class _Phase:
+    def __init__(self, stats, name):
+        self._stats = stats
+        self._name = name
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def __exit__(self, *exc_info):
+        wall, cpu = self._stats.phases.get(self._name, (0.0, 0.0))
+        self._stats.phases[self._name] = (wall + time.perf_counter() - self._wall,
+                                          cpu + time.process_time() - self._cpu)
+
+
+def timed_analyse(analyse, counter):
+    """
+    Analyse 'counter' by 'analyse' and return (seconds, CPU seconds, bytes read). If 'analyse' returns a number, it's
+    the bytes read, e.g. for files which are not on disk, otherwise the file is stat.
+    """
+    start, start_cpu = time.perf_counter(), time.process_time()
+    size = analyse(counter)
+    seconds, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    if size is None:
+        size = os.stat(counter.dof).st_size
+    return seconds, cpu, size
+
+
+class CountStats:
+    """
+    Stats of a count, filled by a DirBuilder given it:
+    - phases: phase name -> (wall seconds, CPU seconds), phases are 'walk', 'dedup' if files are deduplicated,
+      'calc' and 'render', and 'analyse' for the time spent in analysing files, which is part of 'calc'.
+    - files, bytes_read: files analysed and their bytes, not counting files found in a cache.
+    - slowest_files(), slowest_dirs(): the top_n files with the longest analyse, and the top_n directories with the
+      longest total analyse of their files, up to the counted directory 'top'.
+    With jobs > 1, files are timed in the worker processes, and their times and CPU times are recorded when their
+    results come back. Files are then analysed by several processes at once, as by several threads in pipelined
+    count, so 'analyse' may be longer than 'calc'.
+    """
+    def __init__(self, top_n=TOP_N):
+        self.top_n = top_n
+        self.top = ''
+        self.phases = {}
+        self.files = 0
+        self.bytes_read = 0
+        self._slowest = []  # heap of (seconds, path) of top_n slowest files
+        self._dir_times = {}  # directory -> seconds of analyse of its files
+        self._lock = threading.Lock()  # files are analysed by several threads in pipelined count.
+
+    def phase(self, name):
+        """
+        Return a context manager adding its wall and CPU time to phase 'name'.
+        """
+        return _Phase(self, name)
+
+    def record(self, path, seconds, cpu, size):
+        with self._lock:
+            wall_total, cpu_total = self.phases.get('analyse', (0.0, 0.0))
+            self.phases['analyse'] = wall_total + seconds, cpu_total + cpu
+            self.files += 1
+            self.bytes_read += size
+            if len(self._slowest) < self.top_n:
+                heapq.heappush(self._slowest, (seconds, path))
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, (seconds, path))
+            if path == self.top:
+                return
+            directory = os.path.dirname(path)
+            while True:
+                self._dir_times[directory] = self._dir_times.get(directory, 0.0) + seconds
+                parent = os.path.dirname(directory)
+                if directory == self.top or parent == directory or not parent:
+                    break
+                directory = parent
+
+    def wrap(self, analyse):
+        """
+        Return an analyse function recording latency and size of each file analysed by 'analyse', see
+        timed_analyse.
+        """
+        def recorded_analyse(counter):
+            self.record(os.path.normpath(counter.dof), *timed_analyse(analyse, counter))
+        return recorded_analyse
+
+    def slowest_files(self):
+        """
+        Return [(path, seconds)], slowest first.
+        """
+        return [(path, seconds) for seconds, path in sorted(self._slowest, reverse=True)]
+
+    def slowest_dirs(self):
+        """
+        Return [(directory, seconds)], slowest first.
+        """
+        dirs = ((seconds, directory) for directory, seconds in self._dir_times.items())
+        return [(directory, seconds) for seconds, directory in heapq.nlargest(self.top_n, dirs)]
+
+    def to_dict(self):
+        analyse_wall = self.phases.get('analyse', (0.0, 0.0))[0]
+        return {
+            'phases': {name: {'wall': wall, 'cpu': cpu} for name, (wall, cpu) in self.phases.items()},
+            'files': self.files,
+            'bytes_read': self.bytes_read,
+            'mb_per_s': self.bytes_read / (1 << 20) / analyse_wall if analyse_wall else 0.0,
+            'slowest_files': self.slowest_files(),
+            'slowest_dirs': self.slowest_dirs(),
+        }
+
+    def summary(self):
+        """
+        One line summary, e.g. for a status bar.
+        """
+        parts = ['{} {:.2f}s'.format(name, wall) for name, (wall, _) in self.phases.items()]
+        if self.files:
+            parts.append('{} files, {:.1f} MB'.format(self.files, self.bytes_read / (1 << 20)))
+        slowest = self.slowest_files()
+        if slowest:
+            parts.append('slowest {} {:.3f}s'.format(os.path.basename(slowest[0][0]), slowest[0][1]))
+        return ', '.join(parts)
+
+    def __str__(self):
+        lines = ['{:<10} wall {:8.3f} s  cpu {:8.3f} s'.format(name, wall, cpu)
+                 for name, (wall, cpu) in self.phases.items()]
+        stats = self.to_dict()
+        lines.append('{} files analysed, {:.1f} MB read, {:.1f} MB/s'.format(self.files, self.bytes_read / (1 << 20),
+                                                                         stats['mb_per_s']))
+        for title, items in (('slowest files:', stats['slowest_files']), ('slowest directories:',
+                                                                          stats['slowest_dirs'])):
+            if items:
+                lines.append(title)
+                lines += ['  {:8.4f} s  {}'.format(seconds, path) for path, seconds in items]
+        return '\n'.join(lines)
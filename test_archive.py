@@ -0,0 +1,46 @@
+__author__ = 'jim'
+
+import os
+import tempfile
+import unittest
+import zipfile
+import clc
+
+SOURCES = {
+    'pkg/__init__.py': '"""\nPackage.\n"""\n\nVERSION = 1  # version\n',
+    'pkg/mod.py': '# comment\n\ndef f():\n    return 1\n\n\n',
+    'pkg/data.txt': 'not counted\n',
+}
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+def _count(path):
+    builder = _QuietBuilder(path)
+    builder.setup()
+    builder.calc()
+    return builder.tree.children[0].counter.fields()
+
+
+class ArchiveTest(unittest.TestCase):
+    def test_wheel_counts_as_its_directory(self):
+        # the wheel is built in a temporary directory, no archive is kept in the repository.
+        with tempfile.TemporaryDirectory() as tmp:
+            top = os.path.join(tmp, 'src')
+            wheel = os.path.join(tmp, 'pkg-1.0-py3-none-any.whl')
+            with zipfile.ZipFile(wheel, 'w') as zf:
+                for name, text in SOURCES.items():
+                    path = os.path.join(top, *name.split('/'))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'w') as f:
+                        f.write(text)
+                    zf.writestr(name, text)
+            self.assertEqual(_count(wheel), _count(top))
+            self.assertEqual(_count(wheel)[3], 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
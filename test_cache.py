@@ -0,0 +1,68 @@
+__author__ = 'jim'
+
+import os
+import tempfile
+import unittest
+import clc
+from cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, 'mod.py')
+        self.cache_file = os.path.join(self._tmp.name, 'cache.bin')
+        self._write('x = 1\n# comment\n')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write(self, text, mtime_ns=None):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def _count(self):
+        """
+        Count the file through a cache loaded from disk, save it, and return (fields, analysed).
+        """
+        cache = ResultCache(self.cache_file)
+        analysed = []
+
+        def analyse(counter):
+            analysed.append(counter.dof)
+            clc.analyse_file(counter)
+
+        counter = clc.Counter(self.path)
+        cache.wrap(analyse)(counter)
+        cache.save()
+        return counter.fields(), bool(analysed)
+
+    def test_hit_when_unchanged(self):
+        self.assertEqual(self._count(), ((1, 1, 0, 2), True))
+        self.assertEqual(self._count(), ((1, 1, 0, 2), False))
+
+    def test_size_change(self):
+        self._write('x = 1\n# comment\n', mtime_ns=10 ** 18)
+        self._count()
+        self._write('x = 1\n# comment\n\n', mtime_ns=10 ** 18)  # same mtime, other size.
+        self.assertEqual(self._count(), ((1, 1, 1, 3), True))
+
+    def test_mtime_change(self):
+        self._write('x = 1\n# comment\n', mtime_ns=10 ** 18)
+        self._count()
+        self._write('# comment\nx = 1\n', mtime_ns=10 ** 18 + 1)  # same size, other mtime.
+        self.assertEqual(self._count(), ((1, 1, 0, 2), True))
+        self._write('x = 1\ny = 1\n', mtime_ns=10 ** 18 + 2)
+        self.assertEqual(self._count(), ((2, 0, 0, 2), True))
+
+    def test_unrecognized_file_is_empty(self):
+        with open(self.cache_file, 'wb') as f:
+            f.write(b'not a cache')
+        self.assertEqual(self._count(), ((1, 1, 0, 2), True))
+        self.assertEqual(self._count(), ((1, 1, 0, 2), False))
+
+
+if __name__ == '__main__':
+    unittest.main()
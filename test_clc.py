@@ -0,0 +1,81 @@
+__author__ = 'jim'
+
+import os
+import tempfile
+import unittest
+import clc
+import compact
+import stats
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+class _QuietCompactBuilder(compact.CompactDirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+class FindTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._cwd = os.getcwd()
+        os.chdir(self._tmp.name)
+        os.makedirs(os.path.join('top', 'pkg'))
+        with open(os.path.join('top', 'pkg', 'mod.py'), 'w') as f:
+            f.write('x = 1\n# comment\n')
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def _check(self, builder_class, top, path):
+        builder = builder_class(top)
+        builder.setup()
+        builder.calc()
+        node = builder.find(path)
+        self.assertIsNotNone(node, '{} not found in tree of {}'.format(path, top))
+        self.assertEqual(node.counter.line_total, 2)
+
+    def test_absolute_path_in_relative_tree(self):
+        path = os.path.abspath(os.path.join('top', 'pkg', 'mod.py'))
+        self._check(_QuietBuilder, 'top', path)
+        self._check(_QuietBuilder, os.path.join('.', 'top'), path)
+        self._check(_QuietCompactBuilder, 'top', path)
+
+    def test_relative_path_in_absolute_tree(self):
+        top = os.path.abspath('top')
+        self._check(_QuietBuilder, top, os.path.join('top', 'pkg', 'mod.py'))
+        self._check(_QuietBuilder, top, os.path.join('pkg', 'mod.py'))
+        self._check(_QuietCompactBuilder, top, os.path.join('top', 'pkg', 'mod.py'))
+
+    def test_path_outside_tree(self):
+        builder = _QuietBuilder('top')
+        builder.setup()
+        self.assertIsNone(builder.find(os.path.abspath('other.py')))
+
+
+class StatsTest(unittest.TestCase):
+    def test_jobs_record_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(5):
+                with open(os.path.join(tmp, 'm{}.py'.format(i)), 'w') as f:
+                    f.write('x = 1\n' * (i + 1))
+            for builder_class in (_QuietBuilder, _QuietCompactBuilder):
+                results = []
+                for jobs in (1, 2):
+                    count_stats = stats.CountStats()
+                    builder = builder_class(tmp, jobs=jobs, stats=count_stats)
+                    builder.setup()
+                    builder.calc()
+                    results.append((builder.tree.counter.fields(), count_stats.files, count_stats.bytes_read,
+                                    sorted(path for path, _ in count_stats.slowest_files())))
+                    self.assertIn('analyse', count_stats.phases)
+                self.assertEqual(results[0], results[1])
+                self.assertEqual(results[1][1:3], (5, 90))
+
+
+if __name__ == '__main__':
+    unittest.main()
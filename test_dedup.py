@@ -0,0 +1,75 @@
+__author__ = 'jim'
+
+import os
+import tempfile
+import unittest
+import clc
+import compact
+from dedup import ContentIndex
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+class _QuietCompactBuilder(compact.CompactDirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+def _snapshot(builder):
+    return {os.path.normpath(node.counter.dof): node.counter.fields()
+            for node in builder.tree.walker() if not node.is_root()}
+
+
+class ContentIndexTest(unittest.TestCase):
+    FILES = {
+        'a.py': 'x = 1\n# comment\n\n',
+        'vendor/one/a.py': 'x = 1\n# comment\n\n',
+        'vendor/two/a.py': 'x = 1\n# comment\n\n',
+        'same_size.py': 'y = 2\n# comment\n\n',  # same size as a.py, other content.
+        'empty.py': '',
+        'vendor/empty.py': '',
+        'b.py': '"""\ndoc\n"""\nz = 3\n',
+    }
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.top = self._tmp.name
+        for name, text in self.FILES.items():
+            path = os.path.join(self.top, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _count(self, builder_class, **kwargs):
+        builder = builder_class(self.top, **kwargs)
+        builder.setup()
+        builder.calc()
+        return builder
+
+    def test_count_equals_plain_count(self):
+        for builder_class in (_QuietBuilder, _QuietCompactBuilder):
+            plain = self._count(builder_class)
+            for jobs in (1, 2):
+                index = ContentIndex()
+                builder = self._count(builder_class, jobs=jobs, dedup=index)
+                self.assertEqual(_snapshot(builder), _snapshot(plain))
+                self.assertEqual(index.hits, 3)  # two copies of a.py, one of empty.py.
+
+    def test_report(self):
+        index = ContentIndex()
+        builder = self._count(_QuietBuilder, dedup=index)
+        duplicates = index.duplicates()
+        self.assertEqual([(len(paths), fields) for paths, fields in duplicates], [(3, (1, 1, 1, 3)), (2, (0, 0, 0, 0))])
+        self.assertEqual(index.hashed_files, 4)  # files of a size shared with another, empty ones are not read.
+        self.assertTrue(index.report(builder.tree.counter.line_total).startswith(
+            '2 contents with copies, 3 duplicate files, 6 duplicate lines'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+__author__ = 'jim'
+
+import os
+import re
+import tempfile
+import unittest
+import clc
+import ignore
+
+
+class TranslateTest(unittest.TestCase):
+    def _check(self, pattern, matching, not_matching):
+        regex = re.compile(ignore._translate(pattern))
+        for name in matching:
+            self.assertTrue(regex.fullmatch(name), '{} should match {}'.format(pattern, name))
+        for name in not_matching:
+            self.assertFalse(regex.fullmatch(name), '{} should not match {}'.format(pattern, name))
+
+    def test_class_escapes(self):
+        self._check('[\\]a]', [']', 'a'], ['\\', '\\]a]'])
+        self._check('[\\-]', ['-'], ['\\'])
+        self._check('[a\\\\]', ['a', '\\'], ['b'])
+
+    def test_classes(self):
+        self._check('[a-c].py', ['b.py'], ['d.py'])
+        self._check('[!a]x', ['bx'], ['ax'])
+        self._check('[]]', [']'], ['a'])
+        self._check('x[a\\', ['x[a\\'], ['xa'])
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+class WalkFilterTest(unittest.TestCase):
+    FILES = {
+        '.gitignore': 'build/\n*.gen.py\n!keep.gen.py\n',
+        'a.py': 'a = 1\n',
+        'x.gen.py': 'x = 1\n',
+        'keep.gen.py': 'k = 1\n',
+        'build/b.py': 'b = 1\n',
+        'sub/.gitignore': '!x.gen.py\n',
+        'sub/x.gen.py': 'x = 1\n',
+        'sub/y.gen.py': 'y = 1\n',
+        'sub/deep/d.py': 'd = 1\n',
+    }
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.top = self._tmp.name
+        for name, text in self.FILES.items():
+            path = os.path.join(self.top, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _files(self, walk_filter):
+        builder = _QuietBuilder(self.top, walk_filter=walk_filter)
+        builder.setup()
+        return sorted(os.path.relpath(node.counter.dof, self.top).replace(os.sep, '/')
+                      for node in builder.tree.walker() if node.is_leaf() and not node.is_root())
+
+    def test_gitignore_negation(self):
+        walk_filter = ignore.WalkFilter(self.top, rule_files=['.gitignore'])
+        self.assertEqual(self._files(walk_filter), ['a.py', 'keep.gen.py', 'sub/deep/d.py', 'sub/x.gen.py'])
+
+    def test_directory_only_rule(self):
+        walk_filter = ignore.WalkFilter(self.top, rule_files=['.gitignore'])
+        self.assertFalse(walk_filter.keeps(os.path.join(self.top, 'sub', 'build'), True))
+        self.assertTrue(walk_filter.keeps(os.path.join(self.top, 'sub', 'build'), False))
+
+    def test_max_depth(self):
+        self.assertEqual(self._files(ignore.WalkFilter(self.top, max_depth=1)),
+                         ['a.py', 'build/b.py', 'keep.gen.py', 'sub/x.gen.py', 'sub/y.gen.py', 'x.gen.py'])
+        self.assertEqual(self._files(ignore.WalkFilter(self.top, max_depth=0)), ['a.py', 'keep.gen.py', 'x.gen.py'])
+
+    def test_excludes_and_includes(self):
+        walk_filter = ignore.WalkFilter(self.top, excludes=['/sub/deep'], includes=['*.gen.py'])
+        self.assertEqual(self._files(walk_filter), ['keep.gen.py', 'sub/x.gen.py', 'sub/y.gen.py', 'x.gen.py'])
+
+
+if __name__ == '__main__':
+    unittest.main()
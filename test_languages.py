@@ -0,0 +1,53 @@
+__author__ = 'jim'
+
+import io
+import os
+import tempfile
+import unittest
+import clc
+import languages
+
+# lines of white space only, or starting with white space before a comment, in ascii and unicode white space:
+# NBSP, ideographic space, and next line.
+SPACES = ('', ' ', '\t', '\x0c', '\x1c', ' ', '　', '\x85', '  \t', '　 ')
+TEXT = ''.join('{0}\n{0}# comment\n{0}x = 1\n'.format(space) for space in SPACES) + '　'
+
+
+def _stream_count(analyse, data, chunk_size):
+    counter = clc.Counter('file')
+    analyse(counter, io.BytesIO(data), chunk_size)
+    return counter.fields()
+
+
+class ScannerTest(unittest.TestCase):
+    def test_white_space_as_analyse_file(self):
+        scanner = languages.Scanner('Hash', ('.hash',), line_comments=('#',))
+        for newline in ('\n', '\r\n', '\r'):
+            data = TEXT.replace('\n', newline).encode('utf-8')
+            expected = _stream_count(clc.analyse_stream, data, clc.READ_CHUNK_SIZE)
+            self.assertEqual(expected, (len(SPACES), len(SPACES), len(SPACES) + 1, 3 * len(SPACES) + 1))
+            for chunk_size in (1, 7, clc.READ_CHUNK_SIZE):
+                self.assertEqual(_stream_count(scanner.scan_stream, data, chunk_size), expected)
+
+    def test_unicode_white_space_in_block_comment(self):
+        scanner = languages.registry('C').scanner_of('a.c')
+        data = 'int x;\n　\n // c\n/*\n 　\n*/\n'.encode('utf-8')
+        # code, comment, blank, total
+        self.assertEqual(_stream_count(scanner.scan_stream, data, clc.READ_CHUNK_SIZE), (1, 3, 2, 6))
+
+    def test_python_docstrings(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mod.py')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('"""\ndocstring\n"""\nx = """\n# in a string\n"""\n' + TEXT)
+            plain = clc.Counter(path)
+            clc.analyse_file(plain)
+            counter = clc.Counter(path)
+            languages.registry('python').analyse(counter)
+            # the docstring is 3 comment lines, the '#' line in a string is code, the rest as analyse_file.
+            code, comment, blank, total = plain.fields()
+            self.assertEqual(counter.fields(), (code - 2, comment + 2, blank, total))
+
+
+if __name__ == '__main__':
+    unittest.main()
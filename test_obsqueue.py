@@ -0,0 +1,34 @@
+__author__ = 'jim'
+
+import threading
+import unittest
+from obsqueue import ObsQueue
+
+
+class ObsQueueTest(unittest.TestCase):
+    def test_observer_exception_keeps_rest_of_batch(self):
+        oq = ObsQueue()
+        calls = []
+
+        def fail():
+            raise RuntimeError('observer failed')
+
+        oq.put(calls.append, 1)
+        oq.put(fail)
+        oq.put(calls.append, 2)
+        oq.put_merged('key', calls.append, 3)
+        with self.assertRaises(RuntimeError):
+            oq.process()
+        self.assertEqual(calls, [1])
+        self.assertEqual(oq.stats()['depth'], 2)
+
+        oq.process()
+        self.assertEqual(calls, [1, 2, 3])
+        waiter = threading.Thread(target=oq.wait_sync, daemon=True)
+        waiter.start()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive(), 'wait_sync blocked after an observer exception')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+__author__ = 'jim'
+
+import os
+import tempfile
+import time
+import unittest
+import clc
+import schedule
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+class _StoppingBuilder(clc.DirBuilder):
+    """
+    Stops the count after 'limit' files, as a deadline coming in the middle of it.
+    """
+    limit = 2
+
+    def cbk_analyse(self, node):
+        self.analysed = getattr(self, 'analysed', []) + [node]
+        return len(self.analysed) < self.limit
+
+
+def _snapshot(tree):
+    return {os.path.normpath(node.counter.dof): (node.counter.fields(), node.pending_files, node.pending_bytes)
+            for node in tree.walker() if not node.is_root()}
+
+
+class ScheduledCountTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.top = self._tmp.name
+        self.sizes = {}
+        for i, name in enumerate(('a.py', os.path.join('pkg', 'b.py'), os.path.join('pkg', 'sub', 'c.py'),
+                                  os.path.join('other', 'd.py'))):
+            path = os.path.join(self.top, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('x = 1\n# comment\n\n' * (i + 1))
+            self.sizes[path] = os.path.getsize(path)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _count(self, builder_class=_QuietBuilder, **kwargs):
+        builder = builder_class(self.top, **kwargs)
+        builder.setup()
+        builder.calc()
+        return builder
+
+    def test_no_deadline_equals_plain_count(self):
+        plain = self._count()
+        for jobs in (1, 2):
+            builder = self._count(jobs=jobs, deadline=time.monotonic() + 3600)
+            self.assertTrue(builder.schedule.complete)
+            self.assertEqual(builder.schedule.pending_bytes, 0)
+            self.assertEqual(_snapshot(builder.tree), _snapshot(plain.tree))
+        builder = _QuietBuilder(self.top)
+        builder.setup()
+        count = schedule.ScheduledCount(builder.tree)  # no deadline.
+        self.assertTrue(count.run())
+        self.assertEqual(_snapshot(builder.tree), _snapshot(plain.tree))
+        self.assertEqual(count.remaining_seconds(), 0)
+
+    def test_expired_deadline(self):
+        for jobs in (1, 2):
+            builder = self._count(jobs=jobs, deadline=time.monotonic())
+            self.assertFalse(builder.schedule.complete)
+            self.assertEqual(builder.schedule.analysed, 0)
+            self.assertEqual(builder.tree.pending_files, len(self.sizes))
+            self.assertEqual(builder.tree.pending_bytes, sum(self.sizes.values()))
+            self.assertEqual(builder.tree.counter.fields(), (0, 0, 0, 0))
+            self.assertTrue(builder.schedule.summary().startswith('partial count: 0 of 4 files'))
+
+    def test_partial_count_is_consistent(self):
+        builder = self._count(_StoppingBuilder, deadline=time.monotonic() + 3600)
+        # the largest files are analysed first.
+        self.assertEqual([node.size for node in builder.analysed], sorted(self.sizes.values(), reverse=True)[:2])
+        self.assertEqual((builder.schedule.analysed, builder.schedule.files), (2, 4))
+        for node in builder.tree.walker(pre_order=False):
+            if node.is_leaf() and not node.is_root():
+                self.assertEqual(node.pending_files, 0 if node in builder.analysed else 1)
+            else:
+                self.assertEqual(node.counter.fields(), tuple(map(sum, zip(*(child.counter.fields()
+                                                                            for child in node.children)))))
+                self.assertEqual(node.pending_files, sum(child.pending_files for child in node.children))
+        self.assertEqual(builder.tree.counter.fields(), (7, 7, 7, 21))
+        self.assertEqual(builder.tree.pending_bytes, builder.schedule.pending_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
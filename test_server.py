@@ -0,0 +1,93 @@
+__author__ = 'jim'
+
+import io
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+import clc
+import client
+import report
+import server
+import shard
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+class CountServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmp, 'src')
+        os.makedirs(os.path.join(self.top, 'pkg'))
+        for name, text in (('a.py', 'x = 1\n'), (os.path.join('pkg', 'b.py'), '# b\n\ny = 2\n')):
+            with open(os.path.join(self.top, name), 'w') as f:
+                f.write(text)
+        self.socket_path = os.path.join(self.tmp, 'clc.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _start(self):
+        count_server = server.CountServer(self.socket_path, use_inotify=False)
+        thread = threading.Thread(target=count_server.serve_forever, daemon=True)
+        thread.start()
+        return count_server, thread
+
+    def _report(self, fmt):
+        builder = _QuietBuilder(self.top)
+        builder.setup()
+        builder.calc()
+        f = io.StringIO()
+        report.write_report(builder.tree, f, fmt)
+        return f.getvalue()
+
+    def test_round_trip(self):
+        count_server, thread = self._start()
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+            payload = client.request('report', self.socket_path, path=self.top, format='csv')
+            self.assertEqual(payload.decode('utf-8'), self._report('csv'))
+
+            # a change is applied before the next answer.
+            with open(os.path.join(self.top, 'a.py'), 'a') as f:
+                f.write('z = 3\n')
+            payload = client.request('report', self.socket_path, path=self.top, format='jsonl')
+            self.assertEqual(payload.decode('utf-8'), self._report('jsonl'))
+
+            root = shard.load(io.BytesIO(client.request('shard', self.socket_path, path=self.top)))
+            self.assertEqual(root.counter.fields(), (3, 1, 1, 5))
+            self.assertEqual(client.request('roots', self.socket_path), (self.top + '\n').encode('utf-8'))
+            with self.assertRaises(client.ServerError):
+                client.request('unknown', self.socket_path)
+
+            self.assertEqual(client.request('stop', self.socket_path), b'')
+            thread.join(5)
+            self.assertFalse(thread.is_alive(), 'server did not stop')
+        finally:
+            count_server.shutdown()
+            count_server.server_close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_socket_takeover(self):
+        # a socket file left by a dead server is replaced, a live server is not.
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(self.socket_path)
+        count_server, thread = self._start()
+        try:
+            with self.assertRaises(OSError):
+                server.CountServer(self.socket_path, use_inotify=False)
+            self.assertEqual(client.request('roots', self.socket_path), b'')
+        finally:
+            count_server.shutdown()
+            count_server.server_close()
+            thread.join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+__author__ = 'jim'
+
+import io
+import os
+import tempfile
+import time
+import unittest
+import clc
+import languages
+import shard
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+def _snapshot(tree):
+    return {os.path.normpath(node.counter.dof): node.counter.fields() for node in tree.walker() if not node.is_root()}
+
+
+class ShardTest(unittest.TestCase):
+    FILES = {
+        'a.py': 'x = 1\n# comment\n\n',
+        'pkg/b.py': '"""\ndoc\n"""\ny = 2\n',
+        'pkg/sub/c.py': 'z = 3\n',
+        'other/d.py': '# d\n',
+    }
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.top = os.path.join(self._tmp.name, 'top')
+        for name, text in self.FILES.items():
+            self._write(name, text)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write(self, name, text):
+        path = os.path.join(self.top, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def _count(self, dof, **kwargs):
+        builder = _QuietBuilder(dof, **kwargs)
+        builder.setup()
+        builder.calc()
+        return builder.tree
+
+    def _round_trip(self, tree, fmt='binary'):
+        f = io.BytesIO()
+        shard.dump([tree], f, fmt)
+        f.seek(0)
+        return shard.load(f)
+
+    def test_round_trip(self):
+        tree = self._count(self.top)
+        for fmt in ('binary', 'json'):
+            root = self._round_trip(tree, fmt)
+            self.assertEqual(_snapshot(root), _snapshot(tree))
+            self.assertEqual(root.counter.fields(), (6, 2, 1, 9))
+            self.assertEqual([node.size for node in root.walker()], [node.size for node in tree.walker()])
+
+    def test_load_refuses_other_files(self):
+        for data in (b'', b'not a shard\n', b'{"format": "clc-shard", "version": 99}\n', shard.MAGIC + b'\x01'):
+            with self.assertRaises(ValueError):
+                shard.load(io.BytesIO(data), 'data')
+
+    def test_merge_sums_tops(self):
+        parts = [self._round_trip(self._count(os.path.join(self.top, name))) for name in ('pkg', 'other', 'a.py')]
+        merged = shard.merge(parts)
+        self.assertEqual(_snapshot(merged), _snapshot(self._count(self.top)))
+        self.assertEqual(merged.counter.fields(), (6, 2, 1, 9))
+
+    def test_later_shard_wins(self):
+        whole = self._round_trip(self._count(self.top))
+        self._write('pkg/sub/c.py', 'z = 3\nw = 4\n')
+        self._write('pkg/sub/e.py', '# e\n')
+        again = self._round_trip(self._count(os.path.join(self.top, 'pkg', 'sub')))
+        merged = shard.merge([whole, again])
+        self.assertEqual(_snapshot(merged), _snapshot(self._count(self.top)))
+        self.assertEqual(merged.counter.fields(), (7, 3, 1, 11))
+
+        # a whole tree given last replaces the subtree counted since, given first.
+        whole = self._round_trip(self._count(self.top))
+        self._write('pkg/sub/c.py', 'z = 3\n')
+        merged = shard.merge([self._round_trip(self._count(os.path.join(self.top, 'pkg', 'sub'))), whole])
+        self.assertEqual(merged.counter.fields(), (7, 3, 1, 11))
+
+    def test_check_refuses_partial_and_languages(self):
+        partial = self._count(self.top, deadline=time.monotonic())
+        languages_tree = self._count(self.top, languages=languages.registry('python'))
+        for tree in (partial, languages_tree):
+            f = io.BytesIO()
+            with self.assertRaises(ValueError):
+                shard.dump([tree], f)
+            self.assertEqual(f.getvalue(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+__author__ = 'jim'
+
+import os
+import shutil
+import tempfile
+import unittest
+import clc
+import watch
+
+
+class _QuietBuilder(clc.DirBuilder):
+    def cbk_analyse(self, node):
+        return True
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _snapshot(builder):
+    # path -> counter fields of each node, whatever the order of children.
+    return {os.path.normpath(node.counter.dof): node.counter.fields()
+            for node in builder.tree.walker() if not node.is_root()}
+
+
+class TreeWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        _write(os.path.join(self.top, 'a.py'), 'x = 1\n')
+        _write(os.path.join(self.top, 'pkg', 'b.py'), '# b\n\ny = 2\n')
+        _write(os.path.join(self.top, 'lone', 'c.py'), 'z = 3\n')
+        _write(os.path.join(self.top, 'notes.txt'), 'not counted\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def _change_files(self):
+        _write(os.path.join(self.top, 'a.py'), 'x = 1\n# grown\n\n')
+        _write(os.path.join(self.top, 'pkg', 'new.py'), 'n = 0\n')
+        _write(os.path.join(self.top, 'added', 'sub', 'd.py'), '"""\nd\n"""\n')
+        os.remove(os.path.join(self.top, 'lone', 'c.py'))  # its directory has no file left.
+        _write(os.path.join(self.top, 'notes.txt'), 'still not counted\n')
+
+    def _check_watched(self, use_inotify, apply_changes):
+        builder = _QuietBuilder(self.top)
+        builder.setup()
+        builder.calc()
+        watcher = watch.TreeWatcher(builder, use_inotify)
+        try:
+            if use_inotify and not isinstance(watcher.backend, watch.InotifyBackend):
+                self.skipTest('inotify not available')
+            self._change_files()
+            apply_changes(watcher)
+            fresh = _QuietBuilder(self.top)
+            fresh.setup()
+            fresh.calc()
+            self.assertEqual(_snapshot(builder), _snapshot(fresh))
+            self.assertNotIn(os.path.join(self.top, 'lone'), _snapshot(builder))
+            self.assertIs(builder.find(os.path.join(self.top, 'added', 'sub', 'd.py')).parent,
+                          builder.find(os.path.join(self.top, 'added', 'sub')))
+        finally:
+            watcher.close()
+
+    def test_poll(self):
+        # a poll compares every stat at once, one check applies all changes.
+        self._check_watched(False, lambda watcher: watcher.check(0))
+
+    def test_inotify(self):
+        self._check_watched(True, lambda watcher: watcher.drain())
+
+
+if __name__ == '__main__':
+    unittest.main()
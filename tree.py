@@ -9,6 +9,7 @@ class Tree:
     def __init__(self):
         self.parent = None
         self.children = []
+        self._index = 0  # index in siblings, maintained by add_child/cut_child.
 
     @property
     def root(self):
@@ -34,9 +35,9 @@ class Tree:
     @property
     def index(self):
         """
-        index in its siblings.
+        index in its siblings. It's kept up to date by add_child/cut_child, so no search is needed.
         """
-        return self.siblings.index(self)
+        return self._index
 
     @property
     def next_sibling(self):
@@ -69,25 +70,39 @@ class Tree:
         Membership testing.
         Check if tree is a descent of current tree or if tree is the same with current tree. Work fine even if
         tree parameter is not a type of Tree.
+        It goes up from tree through its ancestors, so it costs O(depth) instead of a walk of the whole subtree.
         """
-        if tree is self:
-            return True
-        else:
-            for child in self.children:
-                if child.__contains__(tree):
-                    return True
+        if not isinstance(tree, Tree):
+            return False
+        cur_node = tree
+        while cur_node is not None:
+            if cur_node is self:
+                return True
+            cur_node = cur_node.parent
         return False
 
     def add_child(self, child, index: int):
         """
         If index is out of bound, then process as the sequence.insert do, no exception will be raised. i.e. if index
         >= 0, count start from the beginning, if index < 0, count start from the end. Child should not be in the same
-        tree of this node, to prevent circle reference.
-        """
-        if child in self.root:
+        tree of this node, to prevent circle reference. Comparing the roots of both costs O(depth), unless child is a
+        single node, and only the children after index need their index updated, so appending a new node costs O(1).
+        """
+        if child.is_root() and not child.children:
+            # a single node, e.g. a new one, is only in the same tree as itself.
+            if child is self:
+                raise ValueError('The tree you are trying to add is already in the same tree.')
+        elif child.root is self.root:
             raise ValueError('The tree you are trying to add is already in the same tree.')
+        count = len(self.children)
+        if index < 0:
+            index = max(count + index, 0)
+        else:
+            index = min(index, count)
         self.children.insert(index, child)
         child.parent = self
+        for i in range(index, count + 1):
+            self.children[i]._index = i
 
     def cut_child(self, index: int):
         """
@@ -99,6 +114,9 @@ class Tree:
         the_child = self.children.pop(index)
         the_child.parent = None
         # the_child.parent is still there, cut the connection
+        for i in range(the_child._index, len(self.children)):
+            self.children[i]._index = i
+        the_child._index = 0
         return the_child
 
     def append_child(self, child):
@@ -175,18 +193,27 @@ class Tree:
         Deep-first-traversal iterator. Pre-order is default, but can be set to post-order. This is not a binary
         tree and does not support in-order.
         walker is a generator, it can only appear in the for statement(and other situations like comprehension).
-        ?? why it works even if there is no StopIteration(or something like that) exception??
-        Because this is a generator not an iterator, when generators terminate, they automatically raise StopIteration.
+        It uses an explicit stack instead of nested generators, so each node costs O(1) whatever its depth, and the
+        depth is not limited by the recursion limit. Children of a node are read when the walk goes down into them,
+        after the node itself was yielded in pre-order.
         """
         if pre_order:
-            yield self
-
-        for child in self.children:
-            for tree in child.walker(pre_order):
-                yield tree
-
-        if not pre_order:
-            yield self
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                yield node
+                stack.extend(reversed(node.children))
+            return
+
+        stack = [(self, iter(self.children))]  # (node, iterator of its children not walked yet)
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                yield node
+            else:
+                stack.append((child, iter(child.children)))
 
     def locator(self, root=None):
         """
@@ -223,19 +250,47 @@ class Tree:
 
         return cur_node
 
-    def __text_tree(self, leading=''):
+    def text_lines(self):
         """
-        See comments of text_tree.
+        Generate lines of text_tree one by one, without '\\n'. It uses an explicit stack, every node is visited once
+        and whether it has a next sibling is known from its position while pushing, so it costs O(N).
+        Each stack item is either (node, leading, has_next_sibling) or a ready line.
         """
-        text = leading + '+--- ' + str(self) + '\n'
-        for child in self.children:
-            if self.next_sibling is not None:
-                text += child.__text_tree(leading + '|    ')
-            else:
-                text += child.__text_tree(leading + '     ')
-        if (not self.is_leaf()) and (self.next_sibling is not None):
-            text += leading + '|\n'
-        return text
+        yield str(self)
+        stack = []
+        self.__push_children(stack, self, '')
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                yield item
+                continue
+            node, leading, has_next_sibling = item
+            yield leading + '+--- ' + str(node)
+            if not node.is_leaf():
+                if has_next_sibling:
+                    stack.append(leading + '|')
+                    self.__push_children(stack, node, leading + '|    ')
+                else:
+                    self.__push_children(stack, node, leading + '     ')
+
+    @staticmethod
+    def __push_children(stack, node, leading):
+        """
+        Push children of node on stack of text_lines, in reversed order so that the first child is popped first.
+        """
+        last = len(node.children) - 1
+        for i in range(last, -1, -1):
+            stack.append((node.children[i], leading, i < last))
+
+    def write_text_tree(self, f):
+        """
+        Write text_tree to text file object 'f' line by line, the whole text is never built in memory.
+        """
+        lines = self.text_lines()
+        f.write(next(lines))
+        for line in lines:
+            f.write('\n')
+            f.write(line)
 
     def text_tree(self):
         """
@@ -245,10 +300,7 @@ class Tree:
         - for each node A, if A has next sibling, then every descent node of A should has '|' at the same
         line of the descent and under the same column of A's parent.
         """
-        text_list = [str(self) + '\n']
-        for child in self.children:
-            text_list.append(child.__text_tree())
-        return ''.join(text_list)[:-1]  # delete last '\n'
+        return '\n'.join(self.text_lines())
 
 
 if __name__ == '__main__':
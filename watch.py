@@ -0,0 +1,369 @@
+"""
+Watch mode: keep a counted tree up to date while files change, by analysing only changed, added and deleted files
+and applying the difference of their counters to their ancestors.
+"""
+__author__ = 'jim'
+
+import ctypes
+import os
+import select
+import stat
+import struct
+import time
+from clc import Counter, CounterTree
+
+POLL_INTERVAL = 1.0  # seconds between two checks
+_READ_SIZE = 64 << 10  # bytes of inotify events read at once
+
+# inotify constants from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_CLOEXEC = 0o2000000
+_IN_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, then len bytes of name
+
+
+class InotifyBackend:
+    """
+    Changes reported by the Linux inotify API through ctypes, one watch per directory.
+    Raise OSError if inotify is not available.
+    """
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            self._fd = self._libc.inotify_init1(_IN_CLOEXEC)
+        except AttributeError:
+            raise OSError('inotify not available')
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}  # watch descriptor -> directory
+
+    def add_dir(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _IN_MASK)
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def remove_dir(self, directory):
+        pass  # the kernel drops the watch of a deleted directory, IN_IGNORED tells it.
+
+    def pending(self):
+        """
+        Tell whether events are queued, not read yet.
+        """
+        return bool(select.select([self._fd], [], [], 0)[0])
+
+    def changes(self, timeout):
+        """
+        Wait up to 'timeout' seconds for changes. Return the changed paths, or None if events were lost and
+        everything should be checked.
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self._fd, _READ_SIZE)
+        paths = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_len = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+            elif wd in self._dirs and name:
+                paths.append(os.path.join(self._dirs[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollBackend:
+    """
+    Changes found by stat calls: a directory is listed again only when its mtime changed, a file is analysed again
+    only when its (size, mtime_ns, inode) changed. Nothing is read otherwise.
+    """
+    def __init__(self, watcher):
+        self._watcher = watcher
+
+    def add_dir(self, directory):
+        pass
+
+    def remove_dir(self, directory):
+        pass
+
+    def pending(self):
+        return False  # each call of changes compares all the stats, nothing is left for the next one.
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        paths = []
+        for path, mtime_ns in list(self._watcher.dir_mtimes.items()):
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    paths.append(path)
+            except OSError:
+                paths.append(path)
+        for path, identity in list(self._watcher.identities.items()):
+            try:
+                if _identity(os.stat(path)) != identity:
+                    paths.append(path)
+            except OSError:
+                paths.append(path)
+        if self._watcher.top not in self._watcher.identities and self._watcher.top not in self._watcher.dir_mtimes:
+            paths.append(self._watcher.top)  # missing or not counted yet.
+        return paths
+
+    def close(self):
+        pass
+
+
+def _identity(st):
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class TreeWatcher:
+    """
+    Keep the tree of DirBuilder 'builder', already counted, up to date with the file system. Each changed file is
+    analysed again and the difference between its new and old counter is added to each of its ancestors, sibling
+    subtrees are never summed again. Added files and directories get new nodes, deleted ones are cut, and
+    directories left without valid files are removed, as setup would do.
+    builder.cbk_analyse is called for each node whose counter changed, builder.cbk_discover for each added node and
+    builder.cbk_remove for each removed node, so an observer refreshes only the affected nodes.
+    inotify is used if available, unless 'use_inotify' is False, otherwise directories and files are polled.
+    Raise ValueError if the builder counted an archive.
+    """
+    def __init__(self, builder, use_inotify=True):
+        if builder.archive is not None:
+            raise ValueError('Archive "{}" can not be watched'.format(builder.dof))
+        self.builder = builder
+        self.top = os.path.normpath(builder.dof)
+        self.analyse = builder.analyse_function()
+        self.dir_mtimes = {}  # watched directory -> mtime_ns when listed
+        self.identities = {}  # valid file -> (size, mtime_ns, inode) when analysed
+        self._entries = {}  # watched directory -> paths of its sub directories and valid files when listed
+        self._nodes = builder.path_index  # normalized path -> node, kept up to date for builder.find
+        self._changed = False
+
+        self.backend = None
+        if use_inotify:
+            try:
+                self.backend = InotifyBackend()
+            except OSError:
+                pass
+        if self.backend is None:
+            self.backend = PollBackend(self)
+
+        if os.path.isdir(self.top):
+            self._scan_dir(self.top, initial=True)
+        else:
+            # a single file, the events of its directory are filtered.
+            self.backend.add_dir(os.path.dirname(self.top) or os.curdir)
+            if self.top in self._nodes:
+                self.identities[self.top] = _identity(os.stat(self.top))
+
+    def close(self):
+        self.backend.close()
+
+    def check(self, timeout=POLL_INTERVAL):
+        """
+        Wait up to 'timeout' seconds for changes and apply them. Return True if the tree changed.
+        """
+        paths = self.backend.changes(timeout)
+        self._changed = False
+        if paths is None:
+            if os.path.isdir(self.top):
+                self._scan_dir(self.top, recursive=True)
+            else:
+                self._refresh(self.top)
+        else:
+            for path in dict.fromkeys(os.path.normpath(path) for path in paths):
+                self._refresh(path)
+        return self._changed
+
+    def drain(self):
+        """
+        Apply the changes pending now, without waiting. Checks go on until no event at all is left, not until the tree
+        stops changing, as the first events read may be of ignored or unchanged files.
+        """
+        self.check(0)
+        while self.backend.pending():
+            self.check(0)
+
+    def run(self, stop_event, timeout=POLL_INTERVAL):
+        """
+        Check for changes until 'stop_event' is set.
+        """
+        while not stop_event.is_set():
+            self.check(timeout)
+
+    def _refresh(self, path):
+        """
+        Bring the tree up to date with 'path', which may have been changed, added or deleted.
+        """
+        if path != self.top and os.path.dirname(path) not in self._entries:
+            return  # not watched.
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._forget(path)
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        walk_filter = self.builder.walk_filter
+        if path != self.top and walk_filter is not None and not walk_filter.keeps(path, is_dir):
+            return
+        if is_dir:
+            self._scan_dir(path)
+        elif self.builder._is_valid(os.path.basename(path)):
+            self._refresh_file(path, st)
+
+    def _scan_dir(self, directory, initial=False, recursive=False):
+        """
+        List 'directory' and its new sub directories, or all of them if 'recursive', and refresh their entries.
+        In the 'initial' scan, nodes of the count are already there, only the state of files is recorded.
+        """
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+                entries = self.builder._list_dir(directory)
+            except OSError:
+                self._forget(directory)
+                continue
+            if directory not in self.dir_mtimes:
+                self.backend.add_dir(directory)
+            self.dir_mtimes[directory] = mtime_ns
+            listed = set()
+            for path, size in entries:
+                listed.add(path)
+                if size is None:
+                    if recursive or initial or path not in self._entries:
+                        stack.append(path)
+                elif initial:
+                    if path in self._nodes:
+                        try:
+                            self.identities[path] = _identity(os.stat(path))
+                        except OSError:
+                            pass
+                else:
+                    try:
+                        self._refresh_file(path, os.stat(path))
+                    except OSError:
+                        pass  # deleted meanwhile.
+            for path in self._entries.get(directory, set()) - listed:
+                self._forget(path)
+            self._entries[directory] = listed
+
+    def _refresh_file(self, path, st):
+        identity = _identity(st)
+        node = self._nodes.get(path)
+        if node is not None and self.identities.get(path) == identity:
+            return
+        counter = Counter(path)
+        self.analyse(counter)
+        self.identities[path] = identity
+        if node is None:
+            node = CounterTree(directory_or_file=path, size=st.st_size)
+            node.counter = counter
+            self._parent_node(path).append_child(node)
+            self._nodes[path] = node
+            self.builder.cbk_discover(node)
+            delta = counter
+        else:
+            delta = Counter(path)
+            delta += counter
+            delta -= node.counter
+            node.counter.set_fields(counter.fields())
+            node.size = st.st_size
+        self._changed = True
+        self.builder.cbk_analyse(node)
+        self._propagate(node.parent, delta)
+
+    def _parent_node(self, path):
+        """
+        Return the node of the directory of 'path', the nodes of directories missing in the tree are added.
+        """
+        missing = []
+        while path != self.top:
+            path = os.path.dirname(path)
+            node = self._nodes.get(path)
+            if node is not None:
+                break
+            missing.append(path)
+        else:
+            node = self.builder.tree
+        for path in reversed(missing):
+            child = CounterTree(directory_or_file=path)
+            node.append_child(child)
+            self._nodes[path] = child
+            self.builder.cbk_discover(child)
+            node = child
+        return node
+
+    def _propagate(self, node, delta):
+        """
+        Add counter 'delta' to node and its ancestors.
+        """
+        while node is not None:
+            node.counter += delta
+            self.builder.cbk_analyse(node)
+            node = node.parent
+
+    def _forget(self, path):
+        """
+        Drop state of deleted 'path' and its descendants, and remove its node.
+        """
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            self.identities.pop(directory, None)
+            if self.dir_mtimes.pop(directory, None) is not None:
+                self.backend.remove_dir(directory)
+            stack.extend(self._entries.pop(directory, ()))
+        parent_entries = self._entries.get(os.path.dirname(path))
+        if parent_entries is not None:
+            parent_entries.discard(path)
+
+        node = self._nodes.get(path)
+        if node is None:
+            return
+        for descendant in node.walker():
+            self._nodes.pop(os.path.normpath(descendant.counter.dof), None)
+        delta = Counter(path)
+        delta -= node.counter
+        parent = node.parent
+        parent.cut_child(node.index)
+        self.builder.cbk_remove(node)
+        # remove directories left without valid files.
+        while not parent.is_root() and parent.is_leaf():
+            node = parent
+            parent = node.parent
+            parent.cut_child(node.index)
+            self._nodes.pop(os.path.normpath(node.counter.dof), None)
+            self.builder.cbk_remove(node)
+        self._changed = True
+        self._propagate(parent, delta)
+
+
+if __name__ == '__main__':
+    import sys
+    from clc import DirBuilder
+    db = DirBuilder(sys.argv[1] if len(sys.argv) > 1 else os.getcwd())
+    db.setup()
+    db.calc()
+    watcher = TreeWatcher(db)
+    print('\nwatching with', type(watcher.backend).__name__)
+    try:
+        while True:
+            if watcher.check():
+                print('\n' + str(db.tree.children[0] if db.tree.children else db.tree))
+    except KeyboardInterrupt:
+        watcher.close()